@@ -0,0 +1,67 @@
+import math
+
+import torch
+
+MAX_AUTO_BATCH_SIZE = 256
+MEMORY_FRACTION = 0.9
+
+
+class BatchMemoryEstimator:
+    '''
+    Estimates the peak memory of a generation batch from the model config:
+    the KV cache for the prompt and all new tokens, plus the prefill logits and activations of the prompt.
+    After an OOM the estimate is scaled up, so the following batches are sized by the observed limit.
+    '''
+
+    def __init__(self, model, max_new_tokens: int, budget: int):
+        config = model.config
+        num_heads = config.num_attention_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+        intermediate_size = getattr(config, "intermediate_size", None) or 4 * config.hidden_size
+        dtype_size = torch.finfo(model.dtype).bits // 8
+
+        self.kv_bytes_per_token = 2 * config.num_hidden_layers * num_kv_heads * head_dim * dtype_size
+        # Prefill logits are upcast to float32
+        self.prefill_bytes_per_token = config.vocab_size * 4 + (4 * config.hidden_size + 3 * intermediate_size) * dtype_size
+        self.max_new_tokens = max_new_tokens
+        self.budget = budget
+        self.scale = 1.0
+
+    def sequence_bytes(self, prompt_length: int):
+        total_length = prompt_length + self.max_new_tokens
+        return self.kv_bytes_per_token * total_length + self.prefill_bytes_per_token * prompt_length
+
+    def fits(self, num_sequences: int, max_length: int):
+        if num_sequences > MAX_AUTO_BATCH_SIZE:
+            return False
+        return num_sequences * self.sequence_bytes(max_length) * self.scale <= self.budget
+
+    def max_sequences(self, max_length: int):
+        num_sequences = int(self.budget / (self.sequence_bytes(max_length) * self.scale))
+        return max(1, min(num_sequences, MAX_AUTO_BATCH_SIZE))
+
+    def on_oom(self, num_sequences: int, max_length: int):
+        # Assume that only half of the failed batch fits
+        fitting_sequences = max(1, math.ceil(num_sequences / 2))
+        self.scale = max(self.scale, self.budget / (fitting_sequences * self.sequence_bytes(max_length)))
+
+
+def create_memory_estimator(model, generation_config, prompt_lengths):
+    '''Estimator for the free memory of the model device, None when it can't be measured.'''
+    device = model.device
+    if device.type != "cuda":
+        return None
+    torch.cuda.empty_cache()
+    free_memory, _ = torch.cuda.mem_get_info(device)
+    budget = int(free_memory * MEMORY_FRACTION)
+    if generation_config.max_new_tokens is not None:
+        max_new_tokens = generation_config.max_new_tokens
+    else:
+        max_new_tokens = max(generation_config.max_length - min(prompt_lengths, default=0), 0)
+    estimator = BatchMemoryEstimator(model, max_new_tokens, budget)
+    print("Auto batch size: {:.1f} GiB budget, {:.1f} MiB per sequence of the longest prompt".format(
+        budget / 2 ** 30,
+        estimator.sequence_bytes(max(prompt_lengths, default=0)) / 2 ** 20
+    ))
+    return estimator
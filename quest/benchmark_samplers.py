@@ -0,0 +1,208 @@
+import time
+import statistics
+from pathlib import Path
+from typing import Sequence
+
+import fire
+import torch
+from torch.profiler import profile, ProfilerActivity
+from transformers import GenerationConfig, GenerationMixin
+from transformers.generation.logits_process import LogitsProcessorList, TopKLogitsWarper, TopPLogitsWarper
+
+from quest.utils import read_jsonl, write_jsonl
+from quest.sampler_hijack import (
+    hijack_samplers,
+    reset_logits_processors,
+    DRYLogitsProcessor,
+    DynamicTemperatureLogitsWarper,
+    EpsilonLogitSpaceWarper,
+    EtaLogitSpaceWarper,
+    MinPLogitSpaceWarper,
+    MinPLogitsWarper,
+    MirostatLogitsWarper,
+    QuadraticSamplingLogitsWarper,
+    RepetitionPenaltyLogitsProcessorWithRange,
+    TailFreeLogitsWarper,
+    TemperatureLogitsWarperCustom,
+    TopALogitSpaceWarper,
+    TopALogitsWarper,
+)
+
+hijack_samplers()
+
+WARPERS = {
+    "temperature": lambda: TemperatureLogitsWarperCustom(1.5),
+    "dynamic_temperature": lambda: DynamicTemperatureLogitsWarper(0.5, 1.5, 1.0),
+    "quadratic_sampling": lambda: QuadraticSamplingLogitsWarper(0.2, 1.0),
+    "top_k": lambda: TopKLogitsWarper(40),
+    "top_p": lambda: TopPLogitsWarper(0.9),
+    "tfs": lambda: TailFreeLogitsWarper(0.95),
+    "top_a": lambda: TopALogitsWarper(0.2),
+    "top_a_logit_space": lambda: TopALogitSpaceWarper(0.2),
+    "min_p": lambda: MinPLogitsWarper(0.1),
+    "min_p_logit_space": lambda: MinPLogitSpaceWarper(0.1),
+    "epsilon_logit_space": lambda: EpsilonLogitSpaceWarper(3e-4),
+    "eta_logit_space": lambda: EtaLogitSpaceWarper(3e-4),
+    "mirostat": lambda: MirostatLogitsWarper(2, 5.0, 0.1),
+    "dry": lambda: DRYLogitsProcessor(0.8, 1.75, 2, []),
+    "repetition_penalty": lambda: RepetitionPenaltyLogitsProcessorWithRange(1.05, 0.0, 0.0, 1024),
+}
+
+
+def build_config_chain(config_path: Path, prompt_length: int, input_ids: torch.LongTensor):
+    generation_config = GenerationConfig.from_pretrained(config_path.parent, config_path.name)
+    mixin = GenerationMixin()
+    processors = mixin._get_logits_processor(
+        generation_config=generation_config,
+        input_ids_seq_length=prompt_length,
+        encoder_input_ids=input_ids,
+        prefix_allowed_tokens_fn=None,
+        logits_processor=LogitsProcessorList()
+    )
+    if not generation_config.do_sample:
+        return processors
+    warpers = mixin._get_logits_warper(generation_config)
+    return LogitsProcessorList(list(processors) + list(warpers))
+
+
+def measure_memory(processor, input_ids, scores):
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        processor(input_ids, scores.clone())
+
+    allocations = 0
+    allocated_bytes = 0
+    changes = []
+    for event in prof.events():
+        usage = event.self_cpu_memory_usage if event.name != "[memory]" else event.cpu_memory_usage
+        if usage == 0:
+            continue
+        if usage > 0:
+            allocations += 1
+            allocated_bytes += usage
+        changes.append((event.time_range.start, usage))
+
+    current_bytes = 0
+    peak_bytes = 0
+    for _, usage in sorted(changes, key=lambda x: x[0]):
+        current_bytes += usage
+        peak_bytes = max(peak_bytes, current_bytes)
+    return allocations, allocated_bytes, peak_bytes
+
+
+def benchmark_processor(processor, vocab_size, batch_size, dtype, iterations, warmup, prompt_length):
+    generator = torch.Generator().manual_seed(42)
+    scores = torch.randn((batch_size, vocab_size), generator=generator).mul(3.0).to(dtype)
+    total_length = prompt_length + warmup + iterations + 1
+    input_ids = torch.randint(0, vocab_size, (batch_size, total_length), generator=generator)
+
+    # Every call is the next decoding step, so the stateful processors take their incremental path
+    reset_logits_processors([processor])
+    timings = []
+    for step in range(warmup + iterations):
+        step_input_ids = input_ids[:, :prompt_length + step]
+        start_time = time.perf_counter()
+        processor(step_input_ids, scores.clone())
+        if step >= warmup:
+            timings.append((time.perf_counter() - start_time) * 1000)
+
+    reset_logits_processors([processor])
+    allocations, allocated_bytes, peak_bytes = measure_memory(processor, input_ids[:, :prompt_length], scores)
+    return {
+        "latency_ms_mean": statistics.mean(timings),
+        "latency_ms_median": statistics.median(timings),
+        "allocations": allocations,
+        "allocated_mb": allocated_bytes / 2 ** 20,
+        "peak_mb": peak_bytes / 2 ** 20,
+    }
+
+
+def run_benchmark(
+    output_path: str,
+    configs_dir: str = "configs",
+    vocab_sizes: Sequence[int] = (32000, 128000, 256000),
+    batch_sizes: Sequence[int] = (1, 4),
+    dtypes: Sequence[str] = ("float32", "bfloat16"),
+    iterations: int = 20,
+    warmup: int = 3,
+    prompt_length: int = 512,
+    num_threads: int = None
+):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    records = []
+    config_paths = sorted(Path(configs_dir).glob("*.json"))
+    for vocab_size in vocab_sizes:
+        for batch_size in batch_sizes:
+            for dtype_name in dtypes:
+                dtype = getattr(torch, dtype_name)
+                cases = [("warper", name, factory()) for name, factory in WARPERS.items()]
+                for config_path in config_paths:
+                    input_ids = torch.zeros((batch_size, prompt_length), dtype=torch.long)
+                    chain = build_config_chain(config_path, prompt_length, input_ids)
+                    cases.append(("chain", config_path.stem, chain))
+
+                for kind, name, processor in cases:
+                    record = {
+                        "kind": kind,
+                        "name": name,
+                        "vocab_size": vocab_size,
+                        "batch_size": batch_size,
+                        "dtype": dtype_name,
+                    }
+                    record.update(benchmark_processor(
+                        processor,
+                        vocab_size=vocab_size,
+                        batch_size=batch_size,
+                        dtype=dtype,
+                        iterations=iterations,
+                        warmup=warmup,
+                        prompt_length=prompt_length
+                    ))
+                    print(
+                        "{kind} {name} vocab={vocab_size} batch={batch_size} {dtype}: "
+                        "{latency_ms_median:.3f} ms, {allocations} allocs, {peak_mb:.1f} MB peak".format(**record)
+                    )
+                    records.append(record)
+
+    write_jsonl(records, output_path)
+
+
+def compare_benchmarks(
+    baseline_path: str,
+    current_path: str,
+    latency_threshold: float = 0.1,
+    memory_threshold: float = 0.1
+):
+    def to_key(record):
+        return (record["kind"], record["name"], record["vocab_size"], record["batch_size"], record["dtype"])
+
+    baseline = {to_key(r): r for r in read_jsonl(baseline_path)}
+    regressions = []
+    for record in read_jsonl(current_path):
+        key = to_key(record)
+        if key not in baseline:
+            continue
+        old_record = baseline[key]
+        checks = (
+            ("latency_ms_median", latency_threshold),
+            ("peak_mb", memory_threshold),
+            ("allocations", memory_threshold),
+        )
+        for field, threshold in checks:
+            old_value, new_value = old_record[field], record[field]
+            if old_value > 0 and (new_value - old_value) / old_value > threshold:
+                regressions.append((key, field, old_value, new_value))
+
+    for key, field, old_value, new_value in regressions:
+        print("REGRESSION {}: {} {:.3f} -> {:.3f}".format(" ".join(map(str, key)), field, old_value, new_value))
+    print(f"{len(regressions)} regressions")
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        "run": run_benchmark,
+        "compare": compare_benchmarks
+    })
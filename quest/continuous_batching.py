@@ -0,0 +1,371 @@
+import copy
+from collections import deque
+
+import torch
+import torch.nn.functional as F
+from transformers import GenerationConfig, LogitsProcessorList, PreTrainedModel
+
+from quest.degeneration import DegenerationDetector
+from quest.sampler_hijack import (
+    append_processor_rows,
+    build_logits_processor,
+    build_logits_warper,
+    depends_on_prompt_length,
+    reset_logits_processors,
+    select_processor_rows,
+    set_sampling_generators,
+    RowGenerators
+)
+
+
+class ActiveSequence:
+    '''
+    Bookkeeping of one sequence in the running batch, its sampler state lives in the rows of the shared chain.
+    '''
+
+    def __init__(self, prompt, max_new_tokens: int, slot: int, stop_matcher=None):
+        self.prompt = prompt
+        self.index = prompt[0]
+        self.prompt_length = len(prompt[1])
+        self.max_new_tokens = max_new_tokens
+        self.slot = slot
+        self.num_new_tokens = 0
+        self.stop_matcher = stop_matcher
+        self.stop_reason = None
+
+    @property
+    def done(self):
+        return self.stop_reason is not None
+
+    def check_stop(self, token: int, eos_token_ids, reason=None):
+        self.num_new_tokens += 1
+        if token in eos_token_ids:
+            return "eos"
+        if self.stop_matcher is not None and self.stop_matcher.update(token):
+            return "stop_string"
+        if reason is not None:
+            return reason
+        if self.num_new_tokens >= self.max_new_tokens:
+            return "length"
+        return None
+
+
+class SlotCapture:
+    '''
+    Top-k raw logits and top-k final scores of every step, in [num_slots, max_steps, k] buffers.
+    Rows of the running batch write into their own slot at their own step, a finished sequence frees its slot.
+    '''
+
+    def __init__(self, num_slots: int, max_steps: int, k: int):
+        self.num_slots = num_slots
+        self.max_steps = max_steps
+        self.k = k
+        self.logits_values = None
+        self.logits_indices = None
+        self.scores_values = None
+        self.scores_indices = None
+        self.last_scores = None
+
+    def allocate(self, scores: torch.FloatTensor):
+        shape = (self.num_slots, self.max_steps, min(self.k, scores.shape[-1]))
+        self.logits_values = torch.empty(shape, dtype=scores.dtype, device=scores.device)
+        self.logits_indices = torch.empty(shape, dtype=torch.int32, device=scores.device)
+        self.scores_values = torch.empty(shape, dtype=scores.dtype, device=scores.device)
+        self.scores_indices = torch.empty(shape, dtype=torch.int32, device=scores.device)
+
+    def record(self, values, indices, slots: torch.LongTensor, steps: torch.LongTensor, scores: torch.FloatTensor):
+        top_values, top_indices = torch.topk(scores, values.shape[-1], dim=-1)
+        values[slots, steps] = top_values
+        indices[slots, steps] = top_indices.int()
+
+    def record_logits(self, slots, steps, logits: torch.FloatTensor):
+        if self.logits_values is None:
+            self.allocate(logits)
+        self.record(self.logits_values, self.logits_indices, slots, steps, logits)
+
+    def record_scores(self, slots, steps, scores: torch.FloatTensor):
+        self.record(self.scores_values, self.scores_indices, slots, steps, scores)
+        self.last_scores = scores
+
+    def to_meta(self, slot: int, num_steps: int):
+        return {
+            "logits_values": self.logits_values[slot, :num_steps].clone(),
+            "logits_indices": self.logits_indices[slot, :num_steps].clone(),
+            "scores_values": self.scores_values[slot, :num_steps].clone(),
+            "scores_indices": self.scores_indices[slot, :num_steps].clone()
+        }
+
+
+def left_pad(prompts, pad_token_id: int, device):
+    max_length = max(len(p) for p in prompts)
+    input_ids = torch.full((len(prompts), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(prompts), max_length), dtype=torch.long)
+    for i, prompt in enumerate(prompts):
+        input_ids[i, max_length - len(prompt):] = torch.tensor(prompt, dtype=torch.long)
+        attention_mask[i, max_length - len(prompt):] = 1
+    return input_ids.to(device), attention_mask.to(device)
+
+
+def left_pad_cache(past_key_values, attention_mask, length: int):
+    pad = length - attention_mask.shape[1]
+    if pad == 0:
+        return past_key_values, attention_mask
+    past_key_values = tuple(tuple(F.pad(t, (0, 0, pad, 0)) for t in layer) for layer in past_key_values)
+    return past_key_values, F.pad(attention_mask, (pad, 0))
+
+
+def merge_caches(past_key_values, attention_mask, new_past_key_values, new_attention_mask):
+    if past_key_values is None:
+        return new_past_key_values, new_attention_mask
+    length = max(attention_mask.shape[1], new_attention_mask.shape[1])
+    past_key_values, attention_mask = left_pad_cache(past_key_values, attention_mask, length)
+    new_past_key_values, new_attention_mask = left_pad_cache(new_past_key_values, new_attention_mask, length)
+    past_key_values = tuple(
+        tuple(torch.cat((t, new_t), dim=0) for t, new_t in zip(layer, new_layer))
+        for layer, new_layer in zip(past_key_values, new_past_key_values)
+    )
+    return past_key_values, torch.cat((attention_mask, new_attention_mask), dim=0)
+
+
+def select_rows(past_key_values, attention_mask, token_ids, rows):
+    rows = torch.tensor(rows, dtype=torch.long, device=attention_mask.device)
+    attention_mask = attention_mask.index_select(0, rows)
+    # Drop the columns that were only kept for the removed sequences
+    start = int(attention_mask.any(dim=0).int().argmax().item())
+    attention_mask = attention_mask[:, start:]
+    past_key_values = tuple(tuple(t.index_select(0, rows)[:, :, start:] for t in layer) for layer in past_key_values)
+    return past_key_values, attention_mask, token_ids.index_select(0, rows)[:, start:]
+
+
+@torch.no_grad()
+def generate_continuous(
+    model: PreTrainedModel,
+    prompts,
+    generation_config: GenerationConfig,
+    num_slots: int,
+    pad_token_id: int,
+    k: int = 30,
+    prefix_cache=None,
+    stop_matchers=None,
+    degeneration_params=None
+):
+    '''
+    Continuous batching: keeps up to `num_slots` sequences decoding together and prefills
+    the next prompts as soon as sequences finish, instead of waiting for the longest one in a static batch.
+    `prompts` are (index, token ids, seed) triples, every sequence is sampled with its own generator.
+    All running sequences share one sampler chain that keeps per-row state, like the Mirostat mu or the repetition
+    penalty window. A new sequence takes its first step in a separate chain on its unpadded prompt,
+    then its rows of state are appended to the running chain, and the rows of finished sequences are dropped.
+    With a PrefixKVCache, prompts are prefilled one by one starting from their longest cached prefix.
+    `stop_matchers` maps indices to StopStringMatcher, a sequence finishes on the first of its stop strings.
+    With `degeneration_params` degenerate sequences free their slot right away.
+    On out of memory the running sequences are restarted with half as many slots.
+    Yields (index, meta) in the order the sequences finish.
+    '''
+    generation_config = copy.deepcopy(generation_config)
+    if isinstance(generation_config.temperature, int):
+        generation_config.temperature = float(generation_config.temperature)
+    # Processors like min_new_tokens count from the prompt length of the whole batch
+    if depends_on_prompt_length(generation_config):
+        raise ValueError("Continuous batching doesn't support min_new_tokens, begin_suppress_tokens or exponential_decay_length_penalty, use static batches")
+    eos_token_ids = generation_config.eos_token_id
+    if not isinstance(eos_token_ids, list):
+        eos_token_ids = [eos_token_ids] if eos_token_ids is not None else []
+
+    def build_chain():
+        processors = build_logits_processor(
+            model,
+            generation_config=generation_config,
+            input_ids_seq_length=0,
+            encoder_input_ids=None,
+            prefix_allowed_tokens_fn=None,
+            logits_processor=LogitsProcessorList()
+        )
+        warpers = build_logits_warper(model, generation_config) if generation_config.do_sample else []
+        return LogitsProcessorList(list(processors) + list(warpers))
+
+    def get_max_new_tokens(prompt_ids):
+        if generation_config.max_new_tokens is not None:
+            return generation_config.max_new_tokens
+        return generation_config.max_length - len(prompt_ids)
+
+    chain, join_chain = build_chain(), build_chain()
+    generators = RowGenerators([])
+    set_sampling_generators(chain, generators)
+    detector = DegenerationDetector(**degeneration_params) if degeneration_params else None
+    capture = SlotCapture(num_slots, max(get_max_new_tokens(prompt_ids) for _, prompt_ids, _ in prompts), k) if prompts else None
+
+    def sample(scores, row_generators):
+        if not generation_config.do_sample:
+            return scores.argmax(dim=-1)
+        return row_generators.multinomial(scores.float().softmax(dim=-1)).squeeze(1)
+
+    def join(new_prompts, logits, slots):
+        '''First step of new sequences, their state joins the running chain in the order of `new_prompts`.'''
+        new_tokens = []
+        new_scores = []
+        for (_, prompt_ids, seed), row_logits, slot in zip(new_prompts, logits.split(1), slots):
+            reset_logits_processors(join_chain)
+            join_generators = RowGenerators([seed])
+            set_sampling_generators(join_chain, join_generators)
+            input_ids = torch.tensor([prompt_ids], dtype=torch.long, device=model.device)
+            row_slots, row_steps = torch.tensor([slot], device=model.device), torch.zeros(1, dtype=torch.long, device=model.device)
+            capture.record_logits(row_slots, row_steps, row_logits)
+            scores = join_chain(input_ids, row_logits)
+            capture.record_scores(row_slots, row_steps, scores)
+            new_tokens.append(sample(scores, join_generators))
+            new_scores.append(scores)
+            append_processor_rows(chain, join_chain)
+            generators.append_rows(join_generators)
+        reset_logits_processors(join_chain)
+        set_sampling_generators(join_chain, None)
+        new_tokens = torch.cat(new_tokens)
+        new_token_ids = left_pad([prompt_ids + [token] for (_, prompt_ids, _), token in zip(new_prompts, new_tokens.tolist())], pad_token_id, model.device)[0]
+        reasons = [None] * len(new_prompts)
+        if detector is not None:
+            join_detector = DegenerationDetector(**degeneration_params)
+            reasons = join_detector.update(new_token_ids, torch.cat(new_scores))
+            detector.append_rows(join_detector)
+        return new_token_ids, new_tokens.tolist(), reasons
+
+    def prefill(prompts):
+        # Copies of the same prompt are prefilled once and expanded
+        unique_prompts = dict()
+        rows = [unique_prompts.setdefault(tuple(prompt), len(unique_prompts)) for prompt in prompts]
+        new_input_ids, new_attention_mask = left_pad(list(unique_prompts), pad_token_id=pad_token_id, device=model.device)
+        position_ids = (new_attention_mask.cumsum(dim=-1) - 1).masked_fill(new_attention_mask == 0, 1)
+        outputs = model(
+            input_ids=new_input_ids,
+            attention_mask=new_attention_mask,
+            position_ids=position_ids,
+            use_cache=True
+        )
+        new_key_values, logits = outputs.past_key_values, outputs.logits[:, -1, :]
+        if len(unique_prompts) < len(prompts):
+            rows = torch.tensor(rows, device=model.device)
+            new_key_values = tuple(tuple(t.index_select(0, rows) for t in layer) for layer in new_key_values)
+            new_attention_mask, logits = new_attention_mask.index_select(0, rows), logits.index_select(0, rows)
+        return new_key_values, new_attention_mask, logits
+
+    def prefill_from_cache(prompt_ids):
+        prefix_length, prefix_key_values = prefix_cache.lookup(prompt_ids)
+        input_ids = torch.tensor([prompt_ids[prefix_length:]], dtype=torch.long, device=model.device)
+        outputs = model(
+            input_ids=input_ids,
+            attention_mask=torch.ones((1, len(prompt_ids)), dtype=torch.long, device=model.device),
+            position_ids=torch.arange(prefix_length, len(prompt_ids), device=model.device).unsqueeze(0),
+            past_key_values=prefix_key_values,
+            use_cache=True
+        )
+        prefix_cache.add(prompt_ids, outputs.past_key_values)
+        return outputs.past_key_values, input_ids.new_ones((1, len(prompt_ids))), outputs.logits[:, -1, :]
+
+    queue = deque(prompts)
+    free_slots = list(range(num_slots - 1, -1, -1))
+    active = []
+    past_key_values = None
+    attention_mask = None
+    # Prompt and sampled tokens of the running rows, right-aligned and one column longer than the attention mask
+    token_ids = None
+    # Slot and step of every running row in the capture
+    slots = None
+    steps = None
+    while queue or active:
+        new_prompts = []
+        try:
+            num_new = min(num_slots - len(active), len(queue))
+            if num_new:
+                new_prompts = [queue.popleft() for _ in range(num_new)]
+                new_slots = [free_slots.pop() for _ in range(num_new)]
+                if prefix_cache is None:
+                    prefills = [prefill([prompt_ids for _, prompt_ids, _ in new_prompts])]
+                else:
+                    prefills = [prefill_from_cache(prompt_ids) for _, prompt_ids, _ in new_prompts]
+                new_token_ids, tokens, reasons = join(new_prompts, torch.cat([logits for _, _, logits in prefills]), new_slots)
+                new_past_key_values, new_attention_mask = None, None
+                for prefill_key_values, prefill_attention_mask, _ in prefills:
+                    new_past_key_values, new_attention_mask = merge_caches(
+                        new_past_key_values, new_attention_mask,
+                        prefill_key_values, prefill_attention_mask
+                    )
+                past_key_values, attention_mask = merge_caches(past_key_values, attention_mask, new_past_key_values, new_attention_mask)
+                if token_ids is None:
+                    token_ids = new_token_ids
+                else:
+                    width = max(token_ids.shape[1], new_token_ids.shape[1])
+                    token_ids = torch.cat((
+                        F.pad(token_ids, (width - token_ids.shape[1], 0), value=pad_token_id),
+                        F.pad(new_token_ids, (width - new_token_ids.shape[1], 0), value=pad_token_id)
+                    ))
+                new_slots = torch.tensor(new_slots, dtype=torch.long, device=model.device)
+                slots = new_slots if slots is None else torch.cat((slots, new_slots))
+                steps = torch.ones_like(new_slots) if steps is None else torch.cat((steps, torch.ones_like(new_slots)))
+                new_sequences = []
+                for prompt, slot, token, reason in zip(new_prompts, new_slots.tolist(), tokens, reasons):
+                    stop_matcher = stop_matchers.get(prompt[0]) if stop_matchers is not None else None
+                    seq = ActiveSequence(prompt, get_max_new_tokens(prompt[1]), slot, stop_matcher=stop_matcher)
+                    seq.stop_reason = seq.check_stop(token, eos_token_ids, reason)
+                    new_sequences.append(seq)
+                active += new_sequences
+            else:
+                attention_mask = F.pad(attention_mask, (0, 1), value=1)
+                position_ids = attention_mask.sum(dim=-1, keepdim=True) - 1
+                outputs = model(
+                    input_ids=token_ids[:, -1:],
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=past_key_values,
+                    use_cache=True
+                )
+                past_key_values, logits = outputs.past_key_values, outputs.logits[:, -1, :]
+                capture.record_logits(slots, steps, logits)
+                scores = chain(token_ids, logits)
+                capture.record_scores(slots, steps, scores)
+                next_tokens = sample(scores, generators)
+                token_ids = torch.cat((token_ids, next_tokens.unsqueeze(1)), dim=1)
+                steps = steps + 1
+                reasons = detector.update(token_ids, scores) if detector is not None else [None] * len(active)
+                for seq, token, reason in zip(active, next_tokens.tolist(), reasons):
+                    seq.stop_reason = seq.check_stop(token, eos_token_ids, reason)
+        except torch.cuda.OutOfMemoryError:
+            # Sequences restart from their seeds, so they generate the same tokens with fewer slots
+            restarted = [seq.prompt for seq in active] + new_prompts
+            if len(restarted) <= 1:
+                raise
+            active = []
+            past_key_values, attention_mask, token_ids, slots, steps = None, None, None, None, None
+            select_processor_rows(chain, [])
+            generators.select_rows([])
+            if detector is not None:
+                detector.select_rows([])
+            torch.cuda.empty_cache()
+            num_slots = max(1, len(restarted) // 2)
+            free_slots = list(range(num_slots - 1, -1, -1))
+            for index, _, _ in restarted:
+                if stop_matchers is not None and stop_matchers.get(index) is not None:
+                    stop_matchers[index].reset()
+            queue.extendleft(reversed(restarted))
+            print(f"Out of memory with {len(restarted)} sequences in continuous batching, restarting them with {num_slots} slots")
+            continue
+
+        if not any(seq.done for seq in active):
+            continue
+        for row, seq in enumerate(active):
+            if seq.done:
+                meta = capture.to_meta(seq.slot, seq.num_new_tokens)
+                meta["output_ids"] = token_ids[row, -seq.num_new_tokens:].clone()
+                meta["stop_reason"] = seq.stop_reason
+                free_slots.append(seq.slot)
+                yield seq.index, meta
+        rows = [i for i, seq in enumerate(active) if not seq.done]
+        active = [active[i] for i in rows]
+        select_processor_rows(chain, rows)
+        generators.select_rows(rows)
+        if detector is not None:
+            detector.select_rows(rows)
+        if not active:
+            past_key_values, attention_mask, token_ids, slots, steps = None, None, None, None, None
+            continue
+        past_key_values, attention_mask, token_ids = select_rows(past_key_values, attention_mask, token_ids, rows)
+        rows = torch.tensor(rows, device=slots.device)
+        slots, steps = slots[rows], steps[rows]
@@ -0,0 +1,137 @@
+from typing import List, Optional
+
+import torch
+from transformers.generation.stopping_criteria import StoppingCriteria
+
+DEFAULT_DEGENERATION_PARAMS = {
+    "window": 64,
+    "max_entropy": 6.0,
+    "max_rank": 50,
+    "max_repetition": 0.8,
+    "ngram_size": 4,
+}
+
+
+def load_degeneration_params(degeneration):
+    '''Detector parameters from `True` for the defaults or a dict of overrides, None when it is off.'''
+    if not degeneration:
+        return None
+    params = dict(DEFAULT_DEGENERATION_PARAMS)
+    if isinstance(degeneration, dict):
+        unknown = set(degeneration) - set(params)
+        if unknown:
+            raise ValueError(f"Unknown degeneration detector parameters: {', '.join(sorted(unknown))}")
+        params.update(degeneration)
+    return params
+
+
+class DegenerationDetector:
+    '''
+    Online check of sampled rows over their last `window` tokens.
+    Token soup: the mean entropy of the final distribution or the median rank of the chosen tokens is too high.
+    Loops: too many n-grams of the window repeat an earlier n-gram of the window.
+    Signals are kept on the device, every step costs one host sync for the whole batch.
+    Every row counts its own steps, so rows of a continuous batch can join and leave with `append_rows` and `select_rows`.
+    The first reason of every row and the step it was found at are kept in `reasons` and `stop_steps`.
+    '''
+
+    def __init__(
+        self,
+        window: int = 64,
+        max_entropy: float = 6.0,
+        max_rank: float = 50,
+        max_repetition: float = 0.8,
+        ngram_size: int = 4
+    ):
+        if window < ngram_size:
+            raise ValueError(f"`window` (={window}) has to be at least `ngram_size` (={ngram_size})")
+        self.window = window
+        self.max_entropy = max_entropy
+        self.max_rank = max_rank
+        self.max_repetition = max_repetition
+        self.ngram_size = ngram_size
+        self.entropies = None
+        self.ranks = None
+        self.reasons = None
+        self.stop_steps = None
+        self.steps = None
+
+    def repetition_rate(self, token_ids: torch.LongTensor) -> torch.FloatTensor:
+        ngrams = token_ids.unfold(1, self.ngram_size, 1)
+        is_same = (ngrams.unsqueeze(2) == ngrams.unsqueeze(1)).all(dim=-1)
+        is_earlier = torch.ones(is_same.shape[1:], dtype=torch.bool, device=token_ids.device).tril(diagonal=-1)
+        return (is_same & is_earlier).any(dim=-1).float().mean(dim=-1)
+
+    def select_rows(self, rows):
+        if self.entropies is None:
+            return
+        index = torch.tensor(rows, dtype=torch.long, device=self.entropies.device)
+        self.entropies = self.entropies.index_select(1, index)
+        self.ranks = self.ranks.index_select(1, index)
+        self.reasons = [self.reasons[row] for row in rows]
+        self.stop_steps = [self.stop_steps[row] for row in rows]
+        self.steps = [self.steps[row] for row in rows]
+
+    def append_rows(self, other: "DegenerationDetector"):
+        if other.entropies is None:
+            return
+        if self.entropies is None:
+            self.entropies, self.ranks = other.entropies, other.ranks
+            self.reasons, self.stop_steps, self.steps = list(other.reasons), list(other.stop_steps), list(other.steps)
+            return
+        self.entropies = torch.cat((self.entropies, other.entropies), dim=1)
+        self.ranks = torch.cat((self.ranks, other.ranks), dim=1)
+        self.reasons += other.reasons
+        self.stop_steps += other.stop_steps
+        self.steps += other.steps
+
+    def update(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> List[Optional[str]]:
+        '''`input_ids` end with the tokens just sampled from `scores`, the final scores of the step.'''
+        batch_size = input_ids.shape[0]
+        if self.entropies is None:
+            self.entropies = torch.zeros((self.window, batch_size), dtype=torch.float32, device=scores.device)
+            self.ranks = torch.zeros((self.window, batch_size), dtype=torch.float32, device=scores.device)
+            self.reasons = [None] * batch_size
+            self.stop_steps = [None] * batch_size
+            self.steps = [0] * batch_size
+
+        scores = scores.float()
+        log_probs = torch.log_softmax(scores, dim=-1)
+        chosen_scores = torch.gather(scores, -1, input_ids[:, -1:])
+        positions = torch.tensor([step % self.window for step in self.steps], dtype=torch.long, device=scores.device)
+        rows = torch.arange(batch_size, device=scores.device)
+        self.entropies[positions, rows] = -(log_probs.exp() * log_probs).nansum(dim=-1)
+        self.ranks[positions, rows] = (scores > chosen_scores).sum(dim=-1).float()
+        self.steps = [step + 1 for step in self.steps]
+        if max(self.steps, default=0) < self.window:
+            return self.reasons
+
+        checks = torch.stack((
+            self.repetition_rate(input_ids[:, -self.window:]) > self.max_repetition,
+            self.entropies.mean(dim=0) > self.max_entropy,
+            self.ranks.median(dim=0).values > self.max_rank,
+        ), dim=1).tolist()
+        for row, row_checks in enumerate(checks):
+            if self.reasons[row] is not None or self.steps[row] < self.window:
+                continue
+            for reason, is_degenerate in zip(("repetition", "entropy", "rank"), row_checks):
+                if is_degenerate:
+                    self.reasons[row] = reason
+                    self.stop_steps[row] = self.steps[row] - 1
+                    break
+        return self.reasons
+
+
+class DegenerationCriteria(StoppingCriteria):
+    '''
+    Finishes the rows of `generate` that the detector marks as degenerate.
+    The final scores of the step are taken from the scores capture of a TopKCaptureLogitsProcessor.
+    '''
+
+    def __init__(self, detector: DegenerationDetector, capture):
+        self.detector = detector
+        self.capture = capture
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        reasons = self.detector.update(input_ids, self.capture.last_scores)
+        return torch.tensor([reason is not None for reason in reasons], dtype=torch.bool, device=input_ids.device)
@@ -1,14 +1,34 @@
 import os
 import json
-from typing import List
+import math
+from collections import Counter
+from contextlib import contextmanager, ExitStack
+from typing import List, Union
 from pathlib import Path
 
 import fire
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig, LogitsProcessorList, StoppingCriteriaList
 
-from quest.utils import read_jsonl, set_random_seed, gen_batch
-from quest.sampler_hijack import hijack_samplers
+from quest.utils import read_jsonl, set_random_seed, gen_length_batches, record_seeds, expand_samples
+from quest.sampler_hijack import (
+    hijack_samplers,
+    global_pool_stats,
+    merge_row_configs,
+    row_sampler_param,
+    RowSamplerParams,
+    TopKCaptureLogitsProcessor,
+    SeededSamplingLogitsWarper
+)
+from quest.meta_shard import MetaShardWriter
+from quest.continuous_batching import generate_continuous
+from quest.manifest import RunManifest, run_fingerprint, meta_dir_for
+from quest.output_writer import OutputWriter, finalize_output
+from quest.prompt_cache import load_tokenized_prompts
+from quest.auto_batch import create_memory_estimator, MAX_AUTO_BATCH_SIZE
+from quest.prefix_cache import get_prefix_cache
+from quest.stop_strings import load_stop_strings, get_token_strings, StopStringMatcher, StopStringsCriteria
+from quest.degeneration import load_degeneration_params, DegenerationDetector, DegenerationCriteria
 
 hijack_samplers()
 
@@ -16,52 +36,94 @@ hijack_samplers()
 def generate(
     model: AutoModelForCausalLM,
     tokenizer: AutoTokenizer,
-    prompts: List[str],
+    prompt_ids: List[List[int]],
     generation_config: GenerationConfig,
+    seeds: List[int],
+    row_params: RowSamplerParams = None,
+    stop_matchers: List[StopStringMatcher] = None,
+    degeneration_params: dict = None
 ):
-    formatted_prompts = [tokenizer.apply_chat_template(
-        [{"role": "user", "content": prompt}],
-        add_generation_prompt=True,
-        tokenize=False
-    ) for prompt in prompts]
-    if tokenizer.pad_token_id is None and generation_config.pad_token_id is not None:
-        tokenizer.pad_token_id = generation_config.pad_token_id
-    data = tokenizer(
-        formatted_prompts,
+    # Copies of the same prompt share one prefill, its cache is expanded to all of them
+    unique_prompts = dict()
+    rows = [unique_prompts.setdefault(tuple(ids), len(unique_prompts)) for ids in prompt_ids]
+    data = tokenizer.pad(
+        {"input_ids": [list(ids) for ids in unique_prompts]},
         return_tensors="pt",
         padding=True
     )
     data = {k: v.to(model.device) for k, v in data.items()}
+    if len(unique_prompts) < len(prompt_ids):
+        rows = torch.tensor(rows, device=model.device)
+        past_key_values = None
+        if data["input_ids"].shape[1] > 1:
+            past_key_values = prefill(model, data["input_ids"][:, :-1], data["attention_mask"][:, :-1])
+        data = {k: v.index_select(0, rows) for k, v in data.items()}
+        if past_key_values is not None:
+            data["past_key_values"] = tuple(tuple(t.index_select(0, rows) for t in layer) for layer in past_key_values)
+    max_steps = generation_config.max_new_tokens or generation_config.max_length
+    capture = TopKCaptureLogitsProcessor(k=30, max_steps=max_steps)
+    logits_processor = LogitsProcessorList([capture, SeededSamplingLogitsWarper(seeds)])
+    if row_params is not None:
+        logits_processor.append(row_params)
+    stopping_criteria = StoppingCriteriaList()
+    stop_strings_criteria, detector = None, None
+    if stop_matchers is not None and any(stop_matchers):
+        stop_strings_criteria = StopStringsCriteria(stop_matchers)
+        stopping_criteria.append(stop_strings_criteria)
+    if degeneration_params:
+        detector = DegenerationDetector(**degeneration_params)
+        stopping_criteria.append(DegenerationCriteria(detector, capture))
     results = model.generate(
         **data,
         generation_config=generation_config,
-        return_dict_in_generate=True,
-        output_scores=True,
-        output_logits=True
+        logits_processor=logits_processor,
+        stopping_criteria=stopping_criteria,
+        return_dict_in_generate=True
     )
-    output_ids = results.sequences
-    logits = torch.stack(results.logits)
-    scores = torch.stack(results.scores)
+    output_ids = results.sequences[:, data["input_ids"].shape[1]:]
 
-    outputs = []
+    # Finished rows keep getting padding until the whole batch is done,
+    # so a row stopped for the first of its reasons, the ones found later only saw the padding.
+    # Rows are cut after the token they stopped on, the padding never gets into the outputs.
+    eos_token_ids = generation_config.eos_token_id
+    if not isinstance(eos_token_ids, list):
+        eos_token_ids = [eos_token_ids] if eos_token_ids is not None else []
+    is_eos = torch.isin(output_ids, torch.tensor(eos_token_ids, dtype=output_ids.dtype, device=output_ids.device))
+    eos_steps = torch.where(is_eos.any(dim=-1), is_eos.int().argmax(dim=-1), -1).tolist()
     metas = []
-    for i, (sample_output_ids, sample_input_ids) in enumerate(zip(output_ids, data["input_ids"])):
-        sample_output_ids = sample_output_ids[len(sample_input_ids):]
-        sample_output = tokenizer.decode(sample_output_ids, skip_special_tokens=True)
-        outputs.append(sample_output)
-        sample_logits = logits[:, i, :]
-        sample_logits_top_values, sample_logits_top_indices = torch.topk(sample_logits, k=30, dim=-1)
-        sample_scores = scores[:, i, :]
-        sample_scores_top_values, sample_scores_top_indices = torch.topk(sample_scores, k=30, dim=-1)
+    for i, eos_step in enumerate(eos_steps):
+        events = [(output_ids.shape[1] - 1, 3, "length")]
+        if eos_step >= 0:
+            events.append((eos_step, 0, "eos"))
+        if stop_strings_criteria is not None and stop_strings_criteria.stop_steps[i] is not None:
+            events.append((stop_strings_criteria.stop_steps[i], 1, "stop_string"))
+        if detector is not None and detector.reasons is not None and detector.reasons[i] is not None:
+            events.append((detector.stop_steps[i], 2, detector.reasons[i]))
+        stop_step, _, stop_reason = min(events)
+        length = stop_step + 1
         metas.append({
-            "logits_values": sample_logits_top_values,
-            "logits_indices": sample_logits_top_indices,
-            "scores_values": sample_scores_top_values,
-            "scores_indices": sample_scores_top_indices,
-            "output_ids": sample_output_ids
+            "logits_values": capture.logits_values[:length, i],
+            "logits_indices": capture.logits_indices[:length, i],
+            "scores_values": capture.scores_values[:length, i],
+            "scores_indices": capture.scores_indices[:length, i],
+            "output_ids": output_ids[i, :length],
+            "stop_reason": stop_reason
         })
 
-    return outputs, metas
+    return metas
+
+
+@torch.no_grad()
+def prefill(model: AutoModelForCausalLM, input_ids: torch.LongTensor, attention_mask: torch.LongTensor):
+    '''KV cache of left padded prompts, `generate` continues from it with the remaining tokens.'''
+    position_ids = (attention_mask.cumsum(dim=-1) - 1).masked_fill(attention_mask == 0, 1)
+    outputs = model(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        position_ids=position_ids,
+        use_cache=True
+    )
+    return outputs.past_key_values
 
 
 def generation_config_to_name(generation_config):
@@ -81,6 +143,105 @@ def generation_config_to_name(generation_config):
     return "_".join(name)
 
 
+def load_generation_config(model_name: str, generation_config_path: str, tokenizer: AutoTokenizer, **overrides):
+    orig_generation_config = GenerationConfig.from_pretrained(model_name)
+    generation_config_path = Path(generation_config_path)
+    generation_config = GenerationConfig.from_pretrained(
+        generation_config_path.parent,
+        generation_config_path.name
+    )
+    generation_config.pad_token_id = orig_generation_config.pad_token_id
+    generation_config.eos_token_id = orig_generation_config.eos_token_id
+    generation_config.bos_token_id = orig_generation_config.bos_token_id
+
+    for key, value in overrides.items():
+        if value is not None:
+            setattr(generation_config, key, value)
+
+    # DRY sequence breakers are set as strings, the processor needs token ids
+    if generation_config.dry_multiplier:
+        generation_config.dry_sequence_breakers = [
+            tokenizer.encode(f"a{s}", add_special_tokens=False)[-1] if isinstance(s, str) else s
+            for s in generation_config.dry_sequence_breakers
+        ]
+    return generation_config
+
+
+def start_run(output_path: str, fingerprint: str, num_records: int, overwrite: bool = False):
+    '''Manifest of the run to resume or to start, None if the run is already complete.'''
+    manifest = RunManifest(meta_dir_for(output_path))
+    if manifest.matches(fingerprint) and not overwrite:
+        if manifest.is_complete:
+            print(f"{output_path} is complete, nothing to do")
+            return None
+        if manifest.completed == num_records:
+            print(f"All records of {output_path} are done, putting them in record order")
+            finalize_output(output_path, manifest)
+            return None
+        print(f"Resuming {output_path} with {manifest.completed} of {num_records} records done")
+        return manifest
+
+    if manifest.data is not None and not overwrite:
+        raise ValueError(f"{output_path} was generated with another config or input, pass --overwrite to regenerate it")
+    if os.path.exists(output_path) and manifest.data is None and not overwrite:
+        print(f"{output_path} has no manifest, moving it to {output_path}.incomplete")
+        os.replace(output_path, output_path + ".incomplete")
+    manifest.start(fingerprint, num_records)
+    return manifest
+
+
+@contextmanager
+def open_output(output_path, manifest, records, tokenizer, record_fields, echo: bool = True):
+    '''Writer of a run, continues after the last committed record and reorders the files once all records are done.'''
+    num_completed = manifest.completed
+    if num_completed:
+        os.truncate(output_path, manifest.output_size)
+    with ExitStack() as stack:
+        w = stack.enter_context(open(output_path, "ab" if num_completed else "wb"))
+        meta_writer = stack.enter_context(MetaShardWriter(meta_dir_for(output_path), k=30, num_samples=num_completed))
+        order_file = stack.enter_context(manifest.open_order())
+        with OutputWriter(
+            output_file=w,
+            meta_writer=meta_writer,
+            order_file=order_file,
+            manifest=manifest,
+            records=records,
+            tokenizer=tokenizer,
+            record_fields=record_fields,
+            num_completed=num_completed,
+            echo=echo
+        ) as writer:
+            yield writer
+    if manifest.completed == manifest.num_records:
+        finalize_output(output_path, manifest)
+
+
+def create_stop_matchers(tokenizer, records, stop_strings):
+    '''A fresh StopStringMatcher for every record whose source has stop strings.'''
+    if not stop_strings:
+        return lambda index: None
+    token_strings = get_token_strings(tokenizer)
+
+    def create_stop_matcher(index):
+        source_stop_strings = stop_strings.get(records[index].get("source"))
+        return StopStringMatcher(source_stop_strings, token_strings) if source_stop_strings else None
+
+    return create_stop_matcher
+
+
+def load_model(model_name: str, load_in_8bit: bool = False, load_in_4bit: bool = False):
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=torch.bfloat16,
+        load_in_8bit=load_in_8bit,
+        load_in_4bit=load_in_4bit,
+        attn_implementation="flash_attention_2",
+        device_map="auto"
+    )
+    model.eval()
+    return torch.compile(model)
+
+
 def infer(
     input_path: str,
     output_path: str,
@@ -88,81 +249,286 @@ def infer(
     generation_config_path: str,
     load_in_8bit: bool = False,
     load_in_4bit: bool = False,
-    batch_size: int = 3,
+    batch_size: Union[int, str] = 3,
+    max_batch_tokens: int = None,
+    length_bucketing: bool = True,
+    continuous_batching: bool = False,
     seed: int = 42,
     temperature: float = None,
     top_p: float = None,
     min_p: float = None,
+    overwrite: bool = False,
+    echo: bool = True,
+    prompt_cache_dir: str = None,
+    prefix_cache_gb: float = 0.0,
+    num_samples: int = 1,
+    stop_strings: Union[str, dict] = None,
+    degeneration: Union[bool, dict] = False,
     model: AutoModelForCausalLM = None
 ):
     set_random_seed(seed)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    generation_config = load_generation_config(
+        model_name,
+        generation_config_path,
+        tokenizer,
+        temperature=temperature,
+        top_p=top_p,
+        min_p=min_p
+    )
+
+    print("Full generation config:", generation_config)
+    print(generation_config_to_name(generation_config))
+
+    global_pool_stats.update(inexact_rows=0, rows=0)
+
+    if tokenizer.pad_token_id is None and generation_config.pad_token_id is not None:
+        tokenizer.pad_token_id = generation_config.pad_token_id
+
+    source_records = list(read_jsonl(input_path))
+    records, source_indices = expand_samples(source_records, num_samples)
+    seeds = record_seeds(records, seed)
+    stop_strings = load_stop_strings(stop_strings) if stop_strings else None
+    degeneration_params = load_degeneration_params(degeneration)
+
+    # Resume from the last committed record if the run was interrupted
+    fingerprint = run_fingerprint(
+        model_name, generation_config, records, seed,
+        stop_strings=stop_strings,
+        degeneration=degeneration_params
+    )
+    manifest = start_run(output_path, fingerprint, len(records), overwrite=overwrite)
+    if manifest is None:
+        return
+
     if model is None:
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype=torch.bfloat16,
-            load_in_8bit=load_in_8bit,
-            load_in_4bit=load_in_4bit,
-            attn_implementation="flash_attention_2",
-            device_map="auto"
+        model = load_model(model_name, load_in_8bit=load_in_8bit, load_in_4bit=load_in_4bit)
+
+    # Restoring cached prefixes needs per-sequence prefill, only the continuous loop has it
+    prefix_cache = None
+    if prefix_cache_gb > 0:
+        if not continuous_batching:
+            print("Prefix cache works with continuous batching, enabling it")
+            continuous_batching = True
+        prefix_cache = get_prefix_cache(model, int(prefix_cache_gb * 2 ** 30))
+        prefix_cache.reset_stats()
+
+    tokenized_prompts = load_tokenized_prompts(tokenizer, input_path, [r["prompt"] for r in source_records], cache_dir=prompt_cache_dir)
+    prompt_lengths = tokenized_prompts.lengths[source_indices]
+    done = set(manifest.read_order())
+    todo = [i for i in range(len(records)) if i not in done]
+    lengths = prompt_lengths[todo].tolist()
+
+    def get_prompt_ids(index):
+        return tokenized_prompts[source_indices[index]].tolist()
+
+    create_stop_matcher = create_stop_matchers(tokenizer, records, stop_strings)
+
+    # With batch_size="auto" batches are sized by the estimated memory of their sequences
+    estimator = None
+    if batch_size == "auto":
+        estimator = create_memory_estimator(model, generation_config, lengths)
+        if estimator is None:
+            print("Auto batch size needs a CUDA device, falling back to batch size 3")
+        batch_size = MAX_AUTO_BATCH_SIZE if estimator is not None else 3
+    batches = (
+        [todo[i] for i in batch_indices]
+        for batch_indices in gen_length_batches(
+            lengths,
+            batch_size,
+            max_batch_tokens=max_batch_tokens,
+            sort=length_bucketing,
+            fits=estimator.fits if estimator is not None else None
         )
-        model.eval()
-        model = torch.compile(model)
+    )
+    batch_sizes = []
 
+    def generate_with_backoff(batch_indices):
+        try:
+            metas = generate(
+                model=model,
+                tokenizer=tokenizer,
+                prompt_ids=[get_prompt_ids(i) for i in batch_indices],
+                generation_config=generation_config,
+                seeds=[seeds[i] for i in batch_indices],
+                stop_matchers=[create_stop_matcher(i) for i in batch_indices],
+                degeneration_params=degeneration_params
+            )
+        except torch.cuda.OutOfMemoryError:
+            if len(batch_indices) == 1:
+                raise
+            metas = None
+        if metas is not None:
+            batch_sizes.append(len(batch_indices))
+            yield batch_indices, metas
+            return
+
+        # Per-record seeds make the halves generate exactly what the whole batch would have
+        torch.cuda.empty_cache()
+        max_length = max(int(prompt_lengths[i]) for i in batch_indices)
+        if estimator is not None:
+            estimator.on_oom(len(batch_indices), max_length)
+        half = math.ceil(len(batch_indices) / 2)
+        print(f"Out of memory with {len(batch_indices)} sequences of up to {max_length} tokens, retrying in two halves")
+        yield from generate_with_backoff(batch_indices[:half])
+        yield from generate_with_backoff(batch_indices[half:])
+
+    def gen_results():
+        if not continuous_batching:
+            for batch_indices in batches:
+                yield from generate_with_backoff(batch_indices)
+            if estimator is not None and batch_sizes:
+                print("Auto batch size settled on up to {} sequences, {:.1f} on average over {} batches".format(
+                    max(batch_sizes), sum(batch_sizes) / len(batch_sizes), len(batch_sizes)
+                ))
+            return
+
+        # batch_size is the number of sequences decoded together
+        num_slots = batch_size
+        if estimator is not None:
+            num_slots = estimator.max_sequences(max(lengths, default=0))
+            print(f"Auto batch size settled on {num_slots} continuous batching slots")
+        order = [i for batch_indices in batches for i in batch_indices]
+        for index, meta in generate_continuous(
+            model=model,
+            prompts=[(i, get_prompt_ids(i), seeds[i]) for i in order],
+            generation_config=generation_config,
+            num_slots=num_slots,
+            pad_token_id=tokenizer.pad_token_id,
+            prefix_cache=prefix_cache,
+            stop_matchers={i: create_stop_matcher(i) for i in order},
+            degeneration_params=degeneration_params
+        ):
+            yield [index], [meta]
+        if prefix_cache is not None and prefix_cache.prompt_tokens:
+            print("Prefix cache: {} of {} prompts hit, {:.1%} of prompt tokens reused, {:.2f} GiB cached".format(
+                prefix_cache.hits, prefix_cache.lookups,
+                prefix_cache.reused_tokens / prefix_cache.prompt_tokens,
+                prefix_cache.num_bytes / 2 ** 30
+            ))
+
+    # Results are written in completion order and put in the original record order when the run is done
+    record_fields = {"model_name": model_name, "config_name": generation_config_to_name(generation_config)}
+    stop_reasons = Counter()
+    with open_output(output_path, manifest, records, tokenizer, record_fields, echo=echo) as writer:
+        for batch_indices, metas in gen_results():
+            stop_reasons.update(meta["stop_reason"] for meta in metas)
+            writer.submit(batch_indices, metas)
+    print("Stop reasons:", ", ".join(f"{reason} {count}" for reason, count in stop_reasons.most_common()))
+
+    if generation_config.candidate_pool_size is not None and global_pool_stats["rows"]:
+        inexact_rows = int(global_pool_stats["inexact_rows"])
+        print(f"Candidate pool may differ from the full vocabulary for {inexact_rows} of {global_pool_stats['rows']} sampled rows")
+
+
+def infer_sweep(
+    input_path: str,
+    runs: List[dict],
+    model_name: str,
+    generation_config_path: str,
+    load_in_8bit: bool = False,
+    load_in_4bit: bool = False,
+    batch_size: int = 3,
+    max_batch_tokens: int = None,
+    length_bucketing: bool = True,
+    seed: int = 42,
+    overwrite: bool = False,
+    echo: bool = False,
+    prompt_cache_dir: str = None,
+    num_samples: int = 1,
+    stop_strings: Union[str, dict] = None,
+    degeneration: Union[bool, dict] = False,
+    model: AutoModelForCausalLM = None
+):
+    '''
+    Several runs over the same prompts in one pass: every batch mixes rows of different runs
+    and every row is sampled with the parameters of its own run.
+    `runs` are dicts with "output_path" and the sampler parameters to override in the config,
+    the runs can differ only in ROW_SAMPLER_PARAMS. Every output is the same as of a separate infer call.
+    '''
+    set_random_seed(seed)
     tokenizer = AutoTokenizer.from_pretrained(model_name)
+    global_pool_stats.update(inexact_rows=0, rows=0)
+    source_records = list(read_jsonl(input_path))
+    records, source_indices = expand_samples(source_records, num_samples)
+    seeds = record_seeds(records, seed)
+    stop_strings = load_stop_strings(stop_strings) if stop_strings else None
+    degeneration_params = load_degeneration_params(degeneration)
 
-    orig_generation_config = GenerationConfig.from_pretrained(model_name)
-    generation_config_path = Path(generation_config_path)
-    generation_config = GenerationConfig.from_pretrained(
-        generation_config_path.parent,
-        generation_config_path.name
-    )
-    generation_config.pad_token_id = orig_generation_config.pad_token_id
-    generation_config.eos_token_id = orig_generation_config.eos_token_id
-    generation_config.bos_token_id = orig_generation_config.bos_token_id
+    output_paths, generation_configs, manifests = [], [], []
+    for run in runs:
+        overrides = dict(run)
+        output_path = overrides.pop("output_path")
+        generation_config = load_generation_config(model_name, generation_config_path, tokenizer, **overrides)
+        if tokenizer.pad_token_id is None and generation_config.pad_token_id is not None:
+            tokenizer.pad_token_id = generation_config.pad_token_id
+        fingerprint = run_fingerprint(
+            model_name, generation_config, records, seed,
+            stop_strings=stop_strings,
+            degeneration=degeneration_params
+        )
+        manifest = start_run(output_path, fingerprint, len(records), overwrite=overwrite)
+        if manifest is None:
+            continue
+        print(output_path, generation_config_to_name(generation_config))
+        output_paths.append(output_path)
+        generation_configs.append(generation_config)
+        manifests.append(manifest)
+    if not manifests:
+        return
 
-    if temperature is not None:
-        generation_config.temperature = temperature
-    if top_p is not None:
-        generation_config.top_p = top_p
-    if min_p is not None:
-        generation_config.min_p = min_p
+    generation_config, row_param_names = merge_row_configs(generation_configs)
+    print("Merged generation config:", generation_config)
+    print("Parameters set per row:", ", ".join(row_param_names) or "none")
 
-    print("Full generation config:", generation_config)
-    print(generation_config_to_name(generation_config))
+    if model is None:
+        model = load_model(model_name, load_in_8bit=load_in_8bit, load_in_4bit=load_in_4bit)
+
+    tokenized_prompts = load_tokenized_prompts(tokenizer, input_path, [r["prompt"] for r in source_records], cache_dir=prompt_cache_dir)
+    # Rows of the same prompt in all runs are next to each other, so they get into one batch and share the prefill
+    done = [set(manifest.read_order()) for manifest in manifests]
+    todo = [
+        (run_index, index)
+        for index in range(len(records))
+        for run_index in range(len(manifests))
+        if index not in done[run_index]
+    ]
+    lengths = [int(tokenized_prompts.lengths[source_indices[index]]) for _, index in todo]
+    create_stop_matcher = create_stop_matchers(tokenizer, records, stop_strings)
 
-    records = list(read_jsonl(input_path))
-    meta_dir = ".".join(output_path.split(".")[:-1])
-    Path(meta_dir).mkdir(parents=True, exist_ok=True)
-    with open(output_path, "w", encoding="utf-8") as w:
-        num = 0
-        for batch in gen_batch(records, batch_size):
-            prompts = [r["prompt"] for r in batch]
-            outputs, metas = generate(
+    with ExitStack() as stack:
+        writers = [
+            stack.enter_context(open_output(
+                output_path,
+                manifest,
+                # Every writer fills the records with its own outputs
+                [dict(record) for record in records],
+                tokenizer,
+                {"model_name": model_name, "config_name": generation_config_to_name(run_config)},
+                echo=echo
+            ))
+            for output_path, manifest, run_config in zip(output_paths, manifests, generation_configs)
+        ]
+        for batch_indices in gen_length_batches(lengths, batch_size, max_batch_tokens=max_batch_tokens, sort=length_bucketing):
+            batch = [todo[i] for i in batch_indices]
+            row_params = RowSamplerParams({
+                name: [row_sampler_param(generation_configs[run_index], name) for run_index, _ in batch]
+                for name in row_param_names
+            })
+            metas = generate(
                 model=model,
                 tokenizer=tokenizer,
-                prompts=prompts,
-                generation_config=generation_config
+                prompt_ids=[tokenized_prompts[source_indices[index]].tolist() for _, index in batch],
+                generation_config=generation_config,
+                seeds=[seeds[index] for _, index in batch],
+                row_params=row_params if row_param_names else None,
+                stop_matchers=[create_stop_matcher(index) for _, index in batch],
+                degeneration_params=degeneration_params
             )
-            for prompt, output in zip(prompts, outputs):
-                print()
-                print("=========")
-                print(prompt)
-                print()
-                print("OUTPUT:")
-                print(output)
-                print("=========")
-                print()
-            for record, output, meta in zip(batch, outputs, metas):
-                record["output"] = output
-                record["model_name"] = model_name
-                record["config_name"] = generation_config_to_name(generation_config)
-                try:
-                    w.write(json.dumps(record, ensure_ascii=False) + "\n")
-                except Exception as e:
-                    print(record)
-                    raise e
-                torch.save(meta, os.path.join(meta_dir, f"{num}.pt"))
-                num += 1
+            for run_index, writer in enumerate(writers):
+                rows = [i for i, (row_run_index, _) in enumerate(batch) if row_run_index == run_index]
+                if rows:
+                    writer.submit([batch[i][1] for i in rows], [metas[i] for i in rows])
 
 
 if __name__ == "__main__":
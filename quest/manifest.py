@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+MANIFEST_FILE = "manifest.json"
+ORDER_FILE = "order.bin"
+ORDER_DTYPE = np.int64
+
+
+def run_fingerprint(model_name, generation_config, records, seed, **options):
+    '''Everything that defines the outputs of a run, batching options excluded.'''
+    data = {
+        "model_name": model_name,
+        "generation_config": generation_config.to_dict(),
+        "records": records,
+        "seed": seed,
+    }
+    # Options like stop strings are added only when they are set, so runs without them keep their old fingerprints
+    data.update({name: value for name, value in options.items() if value})
+    payload = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def write_json_atomic(data, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as w:
+        json.dump(data, w, ensure_ascii=False, indent=4)
+        w.flush()
+        os.fsync(w.fileno())
+    os.replace(tmp_path, path)
+
+
+class RunManifest:
+    '''
+    Progress of an infer run, kept next to the meta shard.
+    Records are written in the order they finish, the record index of every written record is appended to `order.bin`.
+    `completed` records are the ones whose output line, meta and index are all on disk,
+    `output_size` is the size of the output file after them.
+    Everything written after that point is discarded when the run is resumed.
+    When all records are done, the output and the shard are reordered into record order and the run is `complete`.
+    '''
+
+    def __init__(self, meta_dir):
+        self.path = Path(meta_dir) / MANIFEST_FILE
+        self.order_path = Path(meta_dir) / ORDER_FILE
+        self.data = None
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as r:
+                self.data = json.load(r)
+
+    @property
+    def completed(self):
+        return self.data["completed"] if self.data else 0
+
+    @property
+    def num_records(self):
+        return self.data["num_records"]
+
+    @property
+    def output_size(self):
+        return self.data["output_size"] if self.data else 0
+
+    @property
+    def is_complete(self):
+        return bool(self.data and self.data["complete"])
+
+    @property
+    def is_finalizing(self):
+        '''The reordered files are on disk, but may not have replaced the files in completion order yet.'''
+        return bool(self.data and self.data.get("finalizing"))
+
+    def read_order(self):
+        '''Record indices of the completed records in the order they were written.'''
+        if not self.order_path.exists():
+            return []
+        return np.fromfile(self.order_path, dtype=ORDER_DTYPE)[:self.completed].tolist()
+
+    def open_order(self):
+        '''The order file cut to the completed records, open for appending the next ones.'''
+        order = self.read_order()
+        self.order_path.parent.mkdir(parents=True, exist_ok=True)
+        order_file = open(self.order_path, "wb")
+        np.array(order, dtype=ORDER_DTYPE).tofile(order_file)
+        return order_file
+
+    def matches(self, fingerprint):
+        return self.data is not None and self.data["fingerprint"] == fingerprint
+
+    def start(self, fingerprint, num_records):
+        self.data = {
+            "fingerprint": fingerprint,
+            "num_records": num_records,
+            "completed": 0,
+            "output_size": 0,
+            "complete": False,
+        }
+        self.save()
+
+    def commit(self, completed, output_size):
+        self.data["completed"] = completed
+        self.data["output_size"] = output_size
+        self.save()
+
+    def start_finalizing(self):
+        self.data["finalizing"] = True
+        self.save()
+
+    def finish(self, output_size):
+        self.data["output_size"] = output_size
+        self.data["finalizing"] = False
+        self.data["complete"] = True
+        self.save()
+        if self.order_path.exists():
+            os.remove(self.order_path)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(self.data, self.path)
+
+
+def meta_dir_for(output_path):
+    return ".".join(output_path.split(".")[:-1])
+
+
+def is_run_complete(output_path):
+    '''An output file counts as done only if its manifest says so, partial files are resumed.'''
+    return os.path.exists(output_path) and RunManifest(meta_dir_for(output_path)).is_complete
@@ -0,0 +1,164 @@
+import os
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+
+SHARD_VERSION = 1
+HEADER_FILE = "header.json"
+OFFSETS_FILE = "offsets.bin"
+OFFSETS_DTYPE = np.int64
+
+
+def meta_columns(k):
+    '''Column name -> (numpy dtype, per-token shape). Every column has one row per generated token.'''
+    return {
+        "logits_values": (np.float16, (k,)),
+        "logits_indices": (np.int32, (k,)),
+        "scores_values": (np.float16, (k,)),
+        "scores_indices": (np.int32, (k,)),
+        "output_ids": (np.int32, ()),
+    }
+
+
+class MetaShardWriter:
+    '''
+    Append-only columnar shard for per-sample generation metadata.
+
+    A shard is a directory with a small JSON header, one raw binary file per column and
+    an int64 offsets index: sample i owns token rows offsets[i]:offsets[i + 1] of every column.
+    Columns are flushed before the offsets entry, so a crashed run leaves a readable prefix.
+    With `num_samples`, an existing shard is truncated to its first samples and appended to.
+    '''
+
+    def __init__(self, path, k: int = 30, num_samples: int = 0):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.k = k
+        self.columns = meta_columns(k)
+        if num_samples:
+            self.resume(num_samples)
+            return
+        header = {
+            "version": SHARD_VERSION,
+            "k": k,
+            "columns": {name: {"dtype": np.dtype(dtype).name, "shape": list(shape)} for name, (dtype, shape) in self.columns.items()},
+        }
+        with open(self.path / HEADER_FILE, "w", encoding="utf-8") as w:
+            json.dump(header, w)
+        self.files = {name: open(self.path / f"{name}.bin", "wb") for name in self.columns}
+        self.offsets_file = open(self.path / OFFSETS_FILE, "wb")
+        self.num_tokens = 0
+        self.num_samples = 0
+        np.array([0], dtype=OFFSETS_DTYPE).tofile(self.offsets_file)
+        self.offsets_file.flush()
+
+    def resume(self, num_samples: int):
+        reader = MetaShardReader(self.path)
+        assert reader.k == self.k, f"Shard has k={reader.k}, expected {self.k}"
+        assert num_samples <= len(reader), f"Shard has {len(reader)} samples, can't resume from {num_samples}"
+        self.num_tokens = int(reader.offsets[num_samples])
+        self.num_samples = num_samples
+        del reader
+
+        # Drop everything written after the last kept sample
+        for name, (dtype, shape) in self.columns.items():
+            row_size = np.dtype(dtype).itemsize * int(np.prod(shape))
+            os.truncate(self.path / f"{name}.bin", self.num_tokens * row_size)
+        os.truncate(self.path / OFFSETS_FILE, (num_samples + 1) * np.dtype(OFFSETS_DTYPE).itemsize)
+        self.files = {name: open(self.path / f"{name}.bin", "ab") for name in self.columns}
+        self.offsets_file = open(self.path / OFFSETS_FILE, "ab")
+
+    def write(self, meta):
+        num_tokens = None
+        for name, (dtype, shape) in self.columns.items():
+            value = meta[name]
+            if isinstance(value, torch.Tensor):
+                value = value.detach().cpu()
+                if value.dtype == torch.bfloat16:
+                    value = value.float()
+                value = value.numpy()
+            array = np.ascontiguousarray(value, dtype=dtype)
+            assert array.shape[1:] == shape, f"{name}: expected rows of shape {shape}, got {array.shape[1:]}"
+            if num_tokens is None:
+                num_tokens = array.shape[0]
+            assert array.shape[0] == num_tokens, f"{name}: expected {num_tokens} rows, got {array.shape[0]}"
+            array.tofile(self.files[name])
+        for f in self.files.values():
+            f.flush()
+        self.num_tokens += num_tokens
+        self.num_samples += 1
+        np.array([self.num_tokens], dtype=OFFSETS_DTYPE).tofile(self.offsets_file)
+        self.offsets_file.flush()
+
+    def sync(self):
+        for f in list(self.files.values()) + [self.offsets_file]:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.offsets_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MetaShardReader:
+    '''
+    Memory-mapped reader for a MetaShardWriter shard.
+    Samples and token ranges are returned as tensors viewing the mapped files, without copies.
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / HEADER_FILE, encoding="utf-8") as r:
+            header = json.load(r)
+        assert header["version"] == SHARD_VERSION, f"Unsupported shard version {header['version']}"
+        self.k = header["k"]
+        self.offsets = np.fromfile(self.path / OFFSETS_FILE, dtype=OFFSETS_DTYPE)
+        num_tokens = int(self.offsets[-1])
+        self.columns = dict()
+        for name, column in header["columns"].items():
+            dtype, shape = np.dtype(column["dtype"]), tuple(column["shape"])
+            if num_tokens == 0:
+                self.columns[name] = np.empty((0, *shape), dtype=dtype)
+                continue
+            # Copy-on-write mapping keeps torch.from_numpy happy without touching the file
+            self.columns[name] = np.memmap(self.path / f"{name}.bin", dtype=dtype, mode="c", shape=(num_tokens, *shape))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_tokens(self):
+        return int(self.offsets[-1])
+
+    def token_range(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Sample {index} is out of range for a shard of {len(self)} samples")
+        return int(self.offsets[index]), int(self.offsets[index + 1])
+
+    def column(self, name, start: int = 0, end: int = None):
+        '''Rows start:end of a column across all samples.'''
+        return torch.from_numpy(self.columns[name][start:end])
+
+    def get(self, index, start: int = 0, end: int = None):
+        '''Tokens start:end of one sample, as a dict with the same keys infer produced.'''
+        sample_start, sample_end = self.token_range(index)
+        start, end, _ = slice(start, end).indices(sample_end - sample_start)
+        return {name: self.column(name, sample_start + start, sample_start + max(start, end)) for name in self.columns}
+
+    def __getitem__(self, index):
+        return self.get(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.get(index)
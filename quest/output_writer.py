@@ -0,0 +1,161 @@
+import os
+import json
+import queue
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from quest.manifest import ORDER_DTYPE, meta_dir_for
+from quest.meta_shard import HEADER_FILE, MetaShardReader, MetaShardWriter
+
+# Reordered files of a finished run are written here before they replace the files in completion order
+SORTED_SUFFIX = ".sorted"
+
+
+class OutputWriter:
+    '''
+    Background stage of infer: detokenizes generated ids, echoes them, writes records, meta and record indices
+    in the order they finish and commits them to the manifest, while the next batch is generated.
+    Nothing is buffered, so a crash loses only the records after the last commit.
+    The queue is bounded, so generation waits when the writer falls behind.
+    Errors of the worker are raised in the main thread on the next submit or on close.
+    '''
+
+    def __init__(
+        self,
+        output_file,
+        meta_writer,
+        order_file,
+        manifest,
+        records,
+        tokenizer,
+        record_fields,
+        num_completed: int = 0,
+        echo: bool = True,
+        max_queue_size: int = 4
+    ):
+        self.output_file = output_file
+        self.meta_writer = meta_writer
+        self.order_file = order_file
+        self.manifest = manifest
+        self.records = records
+        self.tokenizer = tokenizer
+        self.record_fields = record_fields
+        self.num_completed = num_completed
+        self.echo = echo
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, indices, metas):
+        assert len(metas) == len(indices), f"{len(metas)} metas for {len(indices)} records"
+        self.check()
+        self.queue.put((indices, metas))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            # After a failure the queue is only drained, so that submit never blocks forever
+            if self.error is not None:
+                continue
+            try:
+                self.write(*item)
+            except BaseException as e:
+                self.error = e
+
+    def write(self, indices, metas):
+        outputs = [self.tokenizer.decode(meta["output_ids"], skip_special_tokens=True) for meta in metas]
+        if self.echo:
+            for index, output in zip(indices, outputs):
+                print()
+                print("=========")
+                print(self.records[index]["prompt"])
+                print()
+                print("OUTPUT:")
+                print(output)
+                print("=========")
+                print()
+
+        for index, output, meta in zip(indices, outputs, metas):
+            record = self.records[index]
+            record["output"] = output
+            if "stop_reason" in meta:
+                record["stop_reason"] = meta["stop_reason"]
+            record.update(self.record_fields)
+            try:
+                self.output_file.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+            except Exception as e:
+                print(record)
+                raise e
+            self.meta_writer.write(meta)
+        np.array(indices, dtype=ORDER_DTYPE).tofile(self.order_file)
+        self.num_completed += len(indices)
+
+        # All files are on disk before the manifest points past them
+        for f in (self.output_file, self.order_file):
+            f.flush()
+            os.fsync(f.fileno())
+        self.meta_writer.sync()
+        self.manifest.commit(self.num_completed, self.output_file.tell())
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("Output writer failed") from self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Everything generated before an exception is still written
+        if exc_type is None:
+            self.close()
+            return
+        self.queue.put(None)
+        self.thread.join()
+
+
+def finalize_output(output_path, manifest):
+    '''
+    Reorders the output and the meta shard of a run with all records done into record order and marks it complete.
+    The reordered files are synced before the manifest is marked as finalizing, so an interrupted finalize is replayed.
+    '''
+    meta_dir = Path(meta_dir_for(output_path))
+    sorted_output_path = output_path + SORTED_SUFFIX
+    sorted_meta_dir = meta_dir / SORTED_SUFFIX.lstrip(".")
+    if not manifest.is_finalizing:
+        order = manifest.read_order()
+        assert sorted(order) == list(range(manifest.num_records)), "Every record has to be written exactly once"
+        with open(output_path, "rb") as r:
+            lines = r.read()[:manifest.output_size].splitlines(keepends=True)
+        positions = np.argsort(order)
+        with open(sorted_output_path, "wb") as w:
+            for position in positions:
+                w.write(lines[position])
+            w.flush()
+            os.fsync(w.fileno())
+        reader = MetaShardReader(meta_dir)
+        with MetaShardWriter(sorted_meta_dir, k=reader.k) as meta_writer:
+            for position in positions:
+                meta_writer.write(reader[int(position)])
+            meta_writer.sync()
+        del reader
+        manifest.start_finalizing()
+
+    if os.path.exists(sorted_output_path):
+        os.replace(sorted_output_path, output_path)
+    if sorted_meta_dir.exists():
+        for path in sorted_meta_dir.iterdir():
+            if path.name != HEADER_FILE:
+                os.replace(path, meta_dir / path.name)
+        shutil.rmtree(sorted_meta_dir)
+    manifest.finish(os.path.getsize(output_path))
@@ -0,0 +1,106 @@
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+# One cache per model, kept across infer calls, so sweeps over sampler configs reuse the prompts of the previous ones.
+# Keyed weakly by the model itself, so a new model never gets the cache of a freed one with a reused id
+prefix_caches = weakref.WeakKeyDictionary()
+
+
+class PrefixKVCache:
+    '''
+    LRU cache of prompt KV caches, limited by their total size in bytes.
+    The KV of the first m tokens depends only on those tokens, so any cached prompt that shares
+    a prefix with a new prompt gives the KV of that prefix for free.
+    Prompts are indexed by chained hashes of their `block_size` token blocks to find the longest shared prefix,
+    every hash points to all cached prompts with that prefix, so evicting one of them keeps the others findable.
+    '''
+
+    def __init__(self, max_bytes: int, block_size: int = 16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.entries = OrderedDict()
+        self.block_index = dict()
+        self.num_bytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.reused_tokens = 0
+        self.prompt_tokens = 0
+
+    def block_hashes(self, token_ids):
+        hashes = []
+        prefix_hash = 0
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            prefix_hash = hash((prefix_hash, tuple(token_ids[start:start + self.block_size])))
+            hashes.append(prefix_hash)
+        return hashes
+
+    def lookup(self, token_ids):
+        '''
+        Returns the length and the KV of the longest cached prefix of the prompt.
+        At least one token is left to compute, the logits of the last one are needed for sampling.
+        '''
+        self.lookups += 1
+        self.prompt_tokens += len(token_ids)
+        key = None
+        for prefix_hash in reversed(self.block_hashes(token_ids)):
+            if prefix_hash in self.block_index:
+                # The most recently added prompt with this prefix
+                key = next(reversed(self.block_index[prefix_hash]))
+                break
+        if key is None:
+            return 0, None
+
+        # Hashes only point to a candidate, the match is checked and extended token by token
+        max_length = min(len(key), len(token_ids) - 1)
+        mismatches = np.flatnonzero(np.asarray(key[:max_length]) != np.asarray(token_ids[:max_length]))
+        length = int(mismatches[0]) if len(mismatches) else max_length
+        if length == 0:
+            return 0, None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.reused_tokens += length
+        past_key_values = tuple(tuple(t[:, :, :length] for t in layer) for layer in self.entries[key])
+        return length, past_key_values
+
+    def add(self, token_ids, past_key_values):
+        key = tuple(token_ids)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        size = sum(t.numel() * t.element_size() for layer in past_key_values for t in layer)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = past_key_values
+        self.num_bytes += size
+        for prefix_hash in self.block_hashes(key):
+            self.block_index.setdefault(prefix_hash, dict())[key] = None
+        while self.num_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        key, past_key_values = self.entries.popitem(last=False)
+        self.num_bytes -= sum(t.numel() * t.element_size() for layer in past_key_values for t in layer)
+        for prefix_hash in self.block_hashes(key):
+            keys = self.block_index[prefix_hash]
+            del keys[key]
+            if not keys:
+                del self.block_index[prefix_hash]
+
+    def reset_stats(self):
+        self.lookups = 0
+        self.hits = 0
+        self.reused_tokens = 0
+        self.prompt_tokens = 0
+
+
+def get_prefix_cache(model, max_bytes: int):
+    if model not in prefix_caches:
+        prefix_caches[model] = PrefixKVCache(max_bytes)
+    prefix_cache = prefix_caches[model]
+    prefix_cache.max_bytes = max_bytes
+    while prefix_cache.num_bytes > max_bytes:
+        prefix_cache.evict()
+    return prefix_cache
@@ -1,48 +1,144 @@
-import os
-from collections import Counter
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
-import torch
 import fire
+import torch
+
+from quest.utils import write_jsonl
+from quest.meta_shard import MetaShardReader, HEADER_FILE
+
+
+def histogram(values, num_bins):
+    bins = (values * num_bins).long().clamp(0, num_bins - 1)
+    return torch.bincount(bins, minlength=num_bins)
+
+
+def compute_run_stats(
+    input_dir,
+    num_bins: int = 10,
+    chunk_size: int = 65536
+):
+    '''
+    Token-level statistics for one run, computed with tensor ops over the whole shard in chunks:
+    rank of the chosen token among the top-k final scores, candidate set size,
+    entropy of the final and raw distributions, probability of the chosen token and
+    the raw probability mass kept by the candidate set.
+    Probabilities are computed over the stored top-k, so they are exact only for candidate sets smaller than k.
+    Samples end at their stop token, so every stored token counts.
+    '''
+    reader = MetaShardReader(input_dir)
+    k = reader.k
+    output_ids = reader.column("output_ids").long()
+
+    rank_counts = torch.zeros(k + 2, dtype=torch.long)
+    size_counts = torch.zeros(k + 1, dtype=torch.long)
+    chosen_prob_counts = torch.zeros(num_bins, dtype=torch.long)
+    candidate_mass_counts = torch.zeros(num_bins, dtype=torch.long)
+    sums = {"rank": 0.0, "candidate_size": 0.0, "entropy": 0.0, "raw_entropy": 0.0, "chosen_prob": 0.0, "candidate_mass": 0.0}
+    for start in range(0, reader.num_tokens, chunk_size):
+        end = start + chunk_size
+        chosen_ids = output_ids[start:end]
+        scores_values = reader.column("scores_values", start, end).float()
+        scores_indices = reader.column("scores_indices", start, end).long()
+        logits_values = reader.column("logits_values", start, end).float()
+        logits_indices = reader.column("logits_indices", start, end).long()
+
+        is_candidate = torch.isfinite(scores_values)
+        candidate_size = is_candidate.sum(dim=-1)
+        is_chosen = (scores_indices == chosen_ids.unsqueeze(-1)) & is_candidate
+        # Ranks are 1-based, k + 1 means the chosen token is not in the stored top-k
+        rank = torch.where(is_chosen.any(dim=-1), is_chosen.int().argmax(dim=-1) + 1, k + 1)
 
+        probs = scores_values.softmax(dim=-1)
+        raw_probs = logits_values.softmax(dim=-1)
+        entropy = torch.special.entr(probs).sum(dim=-1)
+        raw_entropy = torch.special.entr(raw_probs).sum(dim=-1)
+        chosen_prob = (probs * is_chosen).sum(dim=-1)
+        candidate_ids = scores_indices.masked_fill(~is_candidate, -1)
+        in_candidates = (logits_indices.unsqueeze(-1) == candidate_ids.unsqueeze(-2)).any(dim=-1)
+        candidate_mass = (raw_probs * in_candidates).sum(dim=-1)
 
-def process_scores(input_dir, pad_token_id: int = 0, k: int = 30, debug: bool = False):
-    possible_cnt = Counter()
-    real_cnt = Counter()
-    all_tokens_count = 0
-    for file_name in os.listdir(input_dir):
-        file_path = os.path.join(input_dir, file_name)
-        if not file_path.endswith(".pt"):
-            continue
-        meta = torch.load(file_path, map_location=torch.device("cpu"))
-        tokens_count = (meta["output_ids"] != 0).sum().item()
-        all_tokens_count += tokens_count
-        values = meta["scores_values"][:tokens_count]
-        indices = meta["scores_indices"][:tokens_count]
-        sampled_counts = (values != float("-Inf")).sum(dim=-1).tolist()
-        for output_id, positions in zip(meta["output_ids"], indices):
-            try:
-                pos = positions.tolist().index(output_id.item()) + 1
-            except ValueError:
-                pos = k
-            real_cnt[pos] += 1
-        possible_cnt.update(sampled_counts)
-
-    for idx in range(k, 0, -1):
-        possible_cnt[idx] += possible_cnt[idx+1]
+        rank_counts += torch.bincount(rank, minlength=k + 2)
+        size_counts += torch.bincount(candidate_size, minlength=k + 1)
+        chosen_prob_counts += histogram(chosen_prob, num_bins)
+        candidate_mass_counts += histogram(candidate_mass, num_bins)
+        sums["rank"] += rank.sum().item()
+        sums["candidate_size"] += candidate_size.sum().item()
+        sums["entropy"] += entropy.sum().item()
+        sums["raw_entropy"] += raw_entropy.sum().item()
+        sums["chosen_prob"] += chosen_prob.sum().item()
+        sums["candidate_mass"] += candidate_mass.sum().item()
+
+    tokens_count = reader.num_tokens
+    stats = {
+        "name": Path(input_dir).name,
+        "k": k,
+        "samples_count": len(reader),
+        "tokens_count": tokens_count,
+        "rank_counts": rank_counts[1:].tolist(),
+        "candidate_size_counts": size_counts.tolist(),
+        "chosen_prob_counts": chosen_prob_counts.tolist(),
+        "candidate_mass_counts": candidate_mass_counts.tolist(),
+    }
+    for key, value in sums.items():
+        stats[f"mean_{key}"] = value / max(tokens_count, 1)
+    return stats
+
+
+def process_scores(
+    input_dir,
+    k: int = 30,
+    debug: bool = False
+):
+    stats = compute_run_stats(input_dir)
+    all_tokens_count = max(stats["tokens_count"], 1)
+    k = min(k, stats["k"])
+
+    # Candidate set has at least idx tokens
+    possible_cnt = stats["candidate_size_counts"][1:]
+    for idx in range(len(possible_cnt) - 2, -1, -1):
+        possible_cnt[idx] += possible_cnt[idx + 1]
+    # Tokens outside the top-k are counted at position k
+    real_cnt = stats["rank_counts"][:k]
+    real_cnt[k - 1] += sum(stats["rank_counts"][k:])
 
     if debug:
-        print("Tokens count:", all_tokens_count)
+        print("Tokens count:", stats["tokens_count"])
         print("Possible positions:")
-    possible_positions = [possible_cnt[idx]/all_tokens_count for idx in range(1, k+1)]
+    possible_positions = [possible_cnt[idx] / all_tokens_count for idx in range(k)]
     if debug:
         print(possible_positions)
         print("Real positions:")
-    real_positions = [real_cnt[idx]/all_tokens_count for idx in range(1, k+1)]
+    real_positions = [real_cnt[idx] / all_tokens_count for idx in range(k)]
     if debug:
         print(real_positions)
 
     return possible_positions, real_positions
 
 
+def compare_runs(
+    *input_dirs,
+    num_workers: int = None,
+    output_path: str = None
+):
+    input_dirs = sorted(d for d in input_dirs if (Path(d) / HEADER_FILE).exists())
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=torch.set_num_threads, initargs=(1,)) as executor:
+        all_stats = list(executor.map(compute_run_stats, input_dirs))
+
+    columns = ("tokens_count", "mean_rank", "mean_candidate_size", "mean_entropy", "mean_raw_entropy", "mean_chosen_prob", "mean_candidate_mass")
+    name_width = max([len(s["name"]) for s in all_stats] + [4])
+    print("name".ljust(name_width), " ".join(c.replace("mean_", "").rjust(14) for c in columns))
+    for stats in all_stats:
+        print(stats["name"].ljust(name_width), " ".join(
+            "{:>14}".format(stats[c]) if isinstance(stats[c], int) else "{:>14.3f}".format(stats[c]) for c in columns
+        ))
+
+    if output_path:
+        write_jsonl(all_stats, output_path)
+
+
 if __name__ == "__main__":
-    fire.Fire(process_scores)
+    fire.Fire({
+        "scores": process_scores,
+        "compare": compare_runs
+    })
@@ -0,0 +1,101 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+# Bump when the way prompts are formatted and tokenized changes
+PROMPT_FORMAT_VERSION = 1
+TOKEN_DTYPE = np.int32
+OFFSETS_DTYPE = np.int64
+# Input files can be in read-only or shared directories, the cache is per user
+DEFAULT_CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "quest" / "tokenized_prompts"
+
+
+def tokenize_prompts(tokenizer, prompts: List[str]):
+    formatted_prompts = [tokenizer.apply_chat_template(
+        [{"role": "user", "content": prompt}],
+        add_generation_prompt=True,
+        tokenize=False
+    ) for prompt in prompts]
+    return tokenizer(formatted_prompts)["input_ids"]
+
+
+def tokenizer_fingerprint(tokenizer):
+    '''Hash of the saved tokenizer files, the chat template is a part of them.'''
+    sha = hashlib.sha256()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tokenizer.save_pretrained(tmp_dir)
+        for file_name in sorted(os.listdir(tmp_dir)):
+            sha.update(file_name.encode("utf-8"))
+            with open(os.path.join(tmp_dir, file_name), "rb") as r:
+                sha.update(r.read())
+    sha.update(str(tokenizer.chat_template).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def prompt_cache_key(tokenizer, input_path):
+    sha = hashlib.sha256()
+    sha.update(str(PROMPT_FORMAT_VERSION).encode("utf-8"))
+    sha.update(tokenizer_fingerprint(tokenizer).encode("utf-8"))
+    with open(input_path, "rb") as r:
+        sha.update(r.read())
+    return sha.hexdigest()[:32]
+
+
+class TokenizedPrompts:
+    '''
+    Chat-formatted token ids of every prompt of a file, memory-mapped from the cache:
+    flat int32 token ids and int64 offsets, prompt i is token_ids[offsets[i]:offsets[i + 1]].
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.offsets = np.fromfile(self.path / "offsets.bin", dtype=OFFSETS_DTYPE)
+        self.lengths = np.diff(self.offsets)
+        if self.offsets[-1] == 0:
+            self.token_ids = np.empty(0, dtype=TOKEN_DTYPE)
+        else:
+            self.token_ids = np.memmap(self.path / "token_ids.bin", dtype=TOKEN_DTYPE, mode="r", shape=(int(self.offsets[-1]),))
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index):
+        return self.token_ids[self.offsets[index]:self.offsets[index + 1]]
+
+    @classmethod
+    def build(cls, path, all_prompt_ids):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written to a temporary directory and renamed, so a cache entry is either complete or absent
+        tmp_path = Path(tempfile.mkdtemp(dir=path.parent, prefix=f".{path.name}."))
+        lengths = [len(prompt_ids) for prompt_ids in all_prompt_ids]
+        offsets = np.zeros(len(lengths) + 1, dtype=OFFSETS_DTYPE)
+        np.cumsum(lengths, out=offsets[1:])
+        offsets.tofile(tmp_path / "offsets.bin")
+        token_ids = np.fromiter((t for prompt_ids in all_prompt_ids for t in prompt_ids), dtype=TOKEN_DTYPE, count=int(offsets[-1]))
+        token_ids.tofile(tmp_path / "token_ids.bin")
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Another run has built the same entry in the meantime
+            shutil.rmtree(tmp_path)
+        return cls(path)
+
+
+def load_tokenized_prompts(tokenizer, input_path, prompts: List[str], cache_dir=None):
+    '''
+    Token ids of the prompts of `input_path`, tokenized once per tokenizer, chat template and file contents.
+    The cache is in `cache_dir`, by default in the user cache directory.
+    '''
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    path = Path(cache_dir) / f"{Path(input_path).stem}_{prompt_cache_key(tokenizer, input_path)}"
+    if path.exists():
+        return TokenizedPrompts(path)
+    print(f"Tokenizing {len(prompts)} prompts into {path}")
+    return TokenizedPrompts.build(path, tokenize_prompts(tokenizer, prompts))
@@ -1,19 +1,113 @@
 # Original file: https://github.com/oobabooga/text-generation-webui/blob/main/modules/sampler_hijack.py
 # Modified by Ilya Gusev
 
+import copy
+import json
 import math
 import pprint
+import weakref
+from collections import OrderedDict
 
 import torch
 import transformers
-from transformers import LogitsWarper, is_torch_xpu_available
+from transformers import LogitsWarper
 from transformers.generation.logits_process import (
     LogitNormalization,
     LogitsProcessor,
-    LogitsProcessorList
+    LogitsProcessorList,
+    EpsilonLogitsWarper,
+    EtaLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper
 )
 
-global_scores = None
+global_pool_stats = {"inexact_rows": 0, "rows": 0}
+# Chains per config, least recently used ones are dropped beyond MAX_CACHED_CHAINS.
+# Processor chains are kept per model and go away with it.
+MAX_CACHED_CHAINS = 32
+logits_warper_cache = OrderedDict()
+logits_processor_cache = weakref.WeakKeyDictionary()
+
+# Sampler parameters that can be set per row of a batch, with the values that turn them off.
+# Every other generation parameter has to be the same for all rows.
+ROW_SAMPLER_PARAMS = {
+    "temperature": 1.0,
+    "top_k": 0,
+    "top_p": 1.0,
+    "min_p": 0.0,
+    "tfs": 1.0,
+    "top_a": 0.0,
+    "dynatemp_low": 1,
+    "dynatemp_high": 1,
+    "dynatemp_exponent": 1,
+    "mirostat_tau": 5,
+    "mirostat_eta": 0.1,
+}
+
+
+class SamplerCandidates:
+    '''
+    Scores of one decoding step with lazily computed statistics shared between warpers.
+    The sorted order can be inherited from the previous step of the chain if it is still valid.
+    `token_ids` are vocabulary ids of the columns when the scores hold only a pool of candidates.
+    '''
+
+    def __init__(
+        self,
+        scores: torch.FloatTensor,
+        sorted_indices: torch.LongTensor = None,
+        token_ids: torch.LongTensor = None,
+        vocab_size: int = None
+    ):
+        self.scores = scores
+        self.token_ids = token_ids
+        self.vocab_size = vocab_size if vocab_size is not None else scores.size(-1)
+        self._sorted_indices = sorted_indices
+        self._sorted_logits = None
+        self._sorted_probs = None
+        self._probs = None
+        self._entropy = None
+
+    @property
+    def is_sorted(self) -> bool:
+        return self._sorted_indices is not None
+
+    @property
+    def sorted_indices(self) -> torch.LongTensor:
+        if self._sorted_indices is None:
+            self._sorted_logits, self._sorted_indices = torch.sort(self.scores, descending=True)
+        return self._sorted_indices
+
+    @property
+    def sorted_logits(self) -> torch.FloatTensor:
+        if self._sorted_logits is None:
+            self._sorted_logits = torch.gather(self.scores, -1, self.sorted_indices)
+        return self._sorted_logits
+
+    @property
+    def sorted_probs(self) -> torch.FloatTensor:
+        if self._sorted_probs is None:
+            self._sorted_probs = self.sorted_logits.softmax(dim=-1)
+        return self._sorted_probs
+
+    @property
+    def probs(self) -> torch.FloatTensor:
+        if self._probs is None:
+            self._probs = torch.softmax(self.scores, dim=-1)
+        return self._probs
+
+    @property
+    def entropy(self) -> torch.FloatTensor:
+        if self._entropy is None:
+            probs = self.probs
+            self._entropy = -1.0 * torch.where(probs > 0, probs * torch.log(probs), torch.zeros_like(probs)).sum(dim=-1, keepdim=True)
+        return self._entropy
+
+    def update(self, scores: torch.FloatTensor, keeps_order: bool) -> "SamplerCandidates":
+        if scores is self.scores:
+            return self
+        sorted_indices = self._sorted_indices if keeps_order else None
+        return SamplerCandidates(scores, sorted_indices, self.token_ids, self.vocab_size)
 
 
 class TemperatureLogitsWarperCustom(LogitsWarper):
@@ -21,6 +115,8 @@ class TemperatureLogitsWarperCustom(LogitsWarper):
     A copy of the original Transformers temperature logits warper.
     '''
 
+    keeps_order = True
+
     def __init__(self, temperature: float):
         if not isinstance(temperature, float) or not (temperature > 0):
             except_msg = (
@@ -42,6 +138,8 @@ class TemperatureLogitsWarperCustom(LogitsWarper):
 class DynamicTemperatureLogitsWarper(LogitsWarper):
     '''
     Dynamic temperature.
+    Entropy and temperature are computed per row and stay on the device,
+    so there are no host syncs and every sequence in a batch gets its own temperature.
     '''
 
     def __init__(self, dynatemp_low: float, dynatemp_high: float, dynatemp_exponent: float):
@@ -49,28 +147,31 @@ class DynamicTemperatureLogitsWarper(LogitsWarper):
         self.dynatemp_high = dynatemp_high
         self.dynatemp_exponent = dynatemp_exponent
 
+    keeps_order = True
+
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return self.warp_candidates(input_ids, SamplerCandidates(scores))
+
+    def warp_candidates(self, input_ids: torch.LongTensor, candidates: SamplerCandidates) -> torch.FloatTensor:
+        scores = candidates.scores
         min_temp = self.dynatemp_low
         max_temp = self.dynatemp_high
         exponent_val = self.dynatemp_exponent
 
-        # Convert logits to probabilities
-        probs = torch.softmax(scores, dim=-1)
-
-        # Calculate entropy of the softmax probabilities
-        entropy = -1.0 * torch.where(probs > 0, probs * torch.log(probs), torch.zeros_like(probs)).sum()
+        # Calculate entropy of the softmax probabilities, separately for every row
+        entropy = candidates.entropy
 
         # Guard against future possible division by zero
-        entropy = max(entropy, torch.tensor(1e-10))  # Ensures entropy is slightly greater than 0
+        entropy = entropy.clamp(min=1e-10)  # Ensures entropy is slightly greater than 0
 
         # Any logits which are not -Infinity will be considered for calculating max entropy.
-        num_valid_tokens = torch.sum(scores > -float('inf')).item()
+        num_valid_tokens = torch.sum(scores > -float('inf'), dim=-1, keepdim=True)
 
         # Now, calculate the max entropy by using only the valid tokens' count
-        max_entropy = math.log(num_valid_tokens)
+        max_entropy = torch.log(num_valid_tokens.to(scores.dtype))
 
         # Guard against future possible division by zero
-        max_entropy = max_entropy if max_entropy > 0.0 else 1e-10
+        max_entropy = torch.where(max_entropy > 0.0, max_entropy, torch.full_like(max_entropy, 1e-10))
 
         # Normalize the entropy
         normalized_entropy = entropy / max_entropy
@@ -105,6 +206,11 @@ class QuadraticSamplingLogitsWarper(LogitsWarper):
         self.smoothing_factor = smoothing_factor
         self.smoothing_curve = smoothing_curve
 
+    @property
+    def keeps_order(self):
+        # The transformation is monotonic for non-positive diffs only with these curves
+        return 1.0 <= self.smoothing_curve <= 3.0
+
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
 
         # Compute necessary values
@@ -131,25 +237,29 @@ class MinPLogitsWarper(LogitsWarper):
         self.filter_value = filter_value
         self.min_tokens_to_keep = min_tokens_to_keep
 
+    keeps_order = True
+
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return self.warp_candidates(input_ids, SamplerCandidates(scores))
+
+    def warp_candidates(self, input_ids: torch.LongTensor, candidates: SamplerCandidates) -> torch.FloatTensor:
         # Convert logits to probabilities
-        probs = torch.softmax(scores, dim=-1)
+        probs = candidates.probs
         # Get the probability of the top token for each sequence in the batch
         top_probs, _ = probs.max(dim=-1, keepdim=True)
         # Calculate the actual min_p threshold by scaling min_p with the top token's probability
         scaled_min_p = self.min_p * top_probs
         # Create a mask for tokens that have a probability less than the scaled min_p
-        tokens_to_remove = probs < scaled_min_p
-
-        sorted_indices = torch.argsort(scores, descending=True, dim=-1)
-        sorted_indices_to_remove = torch.gather(tokens_to_remove, dim=-1, index=sorted_indices)
+        indices_to_remove = probs < scaled_min_p
 
         if self.min_tokens_to_keep > 1:
             # Keep at least min_tokens_to_keep
+            sorted_indices = candidates.sorted_indices
+            sorted_indices_to_remove = torch.gather(indices_to_remove, dim=-1, index=sorted_indices)
             sorted_indices_to_remove[..., : self.min_tokens_to_keep] = False
+            indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
 
-        indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
-        scores = scores.masked_fill(indices_to_remove, self.filter_value)
+        scores = candidates.scores.masked_fill(indices_to_remove, self.filter_value)
         return scores
 
 
@@ -162,9 +272,15 @@ class TailFreeLogitsWarper(LogitsWarper):
         self.filter_value = filter_value
         self.min_tokens_to_keep = min_tokens_to_keep
 
+    keeps_order = True
+
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        sorted_logits, sorted_indices = torch.sort(scores, descending=True)
-        probs = sorted_logits.softmax(dim=-1)
+        return self.warp_candidates(input_ids, SamplerCandidates(scores))
+
+    def warp_candidates(self, input_ids: torch.LongTensor, candidates: SamplerCandidates) -> torch.FloatTensor:
+        scores = candidates.scores
+        sorted_indices = candidates.sorted_indices
+        probs = candidates.sorted_probs
 
         # Compute second derivative normalized CDF
         d2 = probs.diff().diff().abs()
@@ -184,6 +300,10 @@ class TailFreeLogitsWarper(LogitsWarper):
             dim=-1,
         )
 
+        if torch.is_tensor(self.tfs):
+            # Rows with tfs = 1 are not filtered, the last token is not dropped either
+            sorted_indices_to_remove &= self.tfs < 1.0
+
         if self.min_tokens_to_keep > 1:
             # Keep at least min_tokens_to_keep
             sorted_indices_to_remove[..., : self.min_tokens_to_keep] = 0
@@ -202,9 +322,15 @@ class TopALogitsWarper(LogitsWarper):
         self.filter_value = filter_value
         self.min_tokens_to_keep = min_tokens_to_keep
 
+    keeps_order = True
+
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        sorted_logits, sorted_indices = torch.sort(scores, descending=True)
-        probs = sorted_logits.softmax(dim=-1)
+        return self.warp_candidates(input_ids, SamplerCandidates(scores))
+
+    def warp_candidates(self, input_ids: torch.LongTensor, candidates: SamplerCandidates) -> torch.FloatTensor:
+        scores = candidates.scores
+        sorted_indices = candidates.sorted_indices
+        probs = candidates.sorted_probs
 
         # Remove tokens with probability less than top_a*(max(probs))^2 (token with 0 are kept)
         probs_max = probs[..., 0, None]
@@ -219,7 +345,104 @@ class TopALogitsWarper(LogitsWarper):
         return scores
 
 
+class LogitThresholdWarper(LogitsWarper):
+    '''
+    Base class for the truncation warpers that compare logits with a per-row threshold.
+    No softmax, sort, gather or scatter, just a reduction and a masked fill.
+    '''
+
+    keeps_order = True
+
+    def threshold(self, scores: torch.FloatTensor) -> torch.FloatTensor:
+        raise NotImplementedError
+
+    def keep_min_tokens(self, indices_to_remove: torch.BoolTensor, candidates: SamplerCandidates) -> torch.BoolTensor:
+        # Keep the words with the 'min_tokens_to_keep'-highest probabilities, even a single one when the threshold removes all
+        scores = candidates.scores
+        top_k = min(self.min_tokens_to_keep, scores.size(-1))  # Safety check
+        return indices_to_remove & (scores < torch.topk(scores, top_k)[0][..., -1, None])
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return self.warp_candidates(input_ids, SamplerCandidates(scores))
+
+    def warp_candidates(self, input_ids: torch.LongTensor, candidates: SamplerCandidates) -> torch.FloatTensor:
+        indices_to_remove = candidates.scores < self.threshold(candidates.scores)
+        indices_to_remove = self.keep_min_tokens(indices_to_remove, candidates)
+        scores = candidates.scores.masked_fill(indices_to_remove, self.filter_value)
+        return scores
+
+
+class SortedMinTokensMixin:
+    '''
+    Keeps the first `min_tokens_to_keep` tokens of the shared sort, like the probability-space min-p and top-a,
+    so tied logits at the last kept position are cut the same way.
+    '''
+
+    def keep_min_tokens(self, indices_to_remove: torch.BoolTensor, candidates: SamplerCandidates) -> torch.BoolTensor:
+        # The threshold never removes the top token, a single token needs no sort
+        if self.min_tokens_to_keep <= 1:
+            return indices_to_remove
+        sorted_indices = candidates.sorted_indices
+        sorted_indices_to_remove = torch.gather(indices_to_remove, dim=-1, index=sorted_indices)
+        sorted_indices_to_remove[..., : self.min_tokens_to_keep] = False
+        return sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+
+
+class MinPLogitSpaceWarper(SortedMinTokensMixin, LogitThresholdWarper, MinPLogitsWarper):
+    '''
+    Min-p in logit space: p_i < min_p * p_max is the same as logit_i < max_logit + log(min_p).
+    '''
+
+    def threshold(self, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if torch.is_tensor(self.min_p):
+            log_min_p = torch.log(self.min_p)
+        else:
+            log_min_p = math.log(self.min_p) if self.min_p > 0 else -float("Inf")
+        return scores.max(dim=-1, keepdim=True)[0] + log_min_p
+
+
+class TopALogitSpaceWarper(SortedMinTokensMixin, LogitThresholdWarper, TopALogitsWarper):
+    '''
+    Top-a in logit space: p_i < top_a * p_max^2 is the same as logit_i < log(top_a) + 2 * max_logit - logsumexp.
+    '''
+
+    def threshold(self, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if torch.is_tensor(self.top_a):
+            log_top_a = torch.log(self.top_a)
+        else:
+            log_top_a = math.log(self.top_a) if self.top_a > 0 else -float("Inf")
+        max_logit = scores.max(dim=-1, keepdim=True)[0]
+        return log_top_a + 2 * max_logit - torch.logsumexp(scores, dim=-1, keepdim=True)
+
+
+class EpsilonLogitSpaceWarper(LogitThresholdWarper, EpsilonLogitsWarper):
+    '''
+    Epsilon cutoff in logit space: p_i < epsilon is the same as logit_i < logsumexp + log(epsilon).
+    '''
+
+    def threshold(self, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return torch.logsumexp(scores, dim=-1, keepdim=True) + math.log(self.epsilon)
+
+
+class EtaLogitSpaceWarper(LogitThresholdWarper, EtaLogitsWarper):
+    '''
+    Eta cutoff in logit space: the threshold is logsumexp + min(log(epsilon), log(epsilon) / 2 - entropy).
+    '''
+
+    def threshold(self, scores: torch.FloatTensor) -> torch.FloatTensor:
+        log_normalizer = torch.logsumexp(scores, dim=-1, keepdim=True)
+        log_probs = scores - log_normalizer
+        entropy = -(log_probs.exp() * log_probs).nansum(dim=-1, keepdim=True)
+        log_epsilon = math.log(float(self.epsilon))
+        return log_normalizer + torch.clamp(log_epsilon / 2 - entropy, max=log_epsilon)
+
+
 class MirostatLogitsWarper(LogitsWarper):
+    '''
+    Mirostat v2 with a separate mu for every sequence in the batch.
+    Runs on the device of the scores.
+    '''
+
     def __init__(self, mirostat_mode: int, mirostat_tau: float, mirostat_eta: float, filter_value: float = -float("Inf"), min_tokens_to_keep: int = 1):
         if mirostat_mode not in [2]:
             raise ValueError(f"`mirostat` has to be a an integer 2, but is {mirostat_mode}")
@@ -229,58 +452,483 @@ class MirostatLogitsWarper(LogitsWarper):
         self.mirostat_tau = mirostat_tau
         self.filter_value = filter_value
         self.min_tokens_to_keep = min_tokens_to_keep
-        self.mu = 2 * self.mirostat_tau
-        self.e = 0
+        self.mu = None
+        self.e = None
+        self.generators = None
+
+    keeps_order = False
+
+    def reset(self):
+        self.mu = None
+        self.e = None
+
+    def select_rows(self, rows):
+        if self.mu is not None:
+            self.mu, self.e = select_state_rows(self.mu, rows), select_state_rows(self.e, rows)
+
+    def append_rows(self, other):
+        if other.mu is not None:
+            self.mu, self.e = append_state_rows(self.mu, other.mu), append_state_rows(self.e, other.e)
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        logits = scores[0]
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        prob_original = torch.softmax(sorted_logits, dim=-1).tolist()  # candidates
-
-        # Truncate the words with surprise values greater than mu
-        for i, candidate in enumerate(prob_original):
-            if candidate > 0 and -math.log2(candidate) > self.mu:
-                if (i == 0):
-                    sorted_logits = sorted_logits[:1]
-                else:
-                    sorted_logits = sorted_logits[:i]
-                break
+        return self.warp_candidates(input_ids, SamplerCandidates(scores))
+
+    def warp_candidates(self, input_ids: torch.LongTensor, candidates: SamplerCandidates) -> torch.FloatTensor:
+        scores = candidates.scores
+        batch_size = scores.shape[0]
+        if self.mu is None or self.mu.shape[0] != batch_size:
+            self.mu = torch.full((batch_size, 1), 2.0, dtype=torch.float32, device=scores.device) * self.mirostat_tau
+            self.e = torch.zeros((batch_size, 1), dtype=torch.float32, device=scores.device)
+
+        sorted_logits, sorted_indices = candidates.sorted_logits, candidates.sorted_indices
+        prob_original = torch.softmax(sorted_logits.float(), dim=-1)  # candidates
+
+        # Truncate the words starting from the first one with surprise value greater than mu
+        surprise = -torch.log2(prob_original)
+        is_surprising = (prob_original > 0) & (surprise > self.mu)
+        sorted_indices_to_remove = is_surprising.cumsum(dim=-1) > 0
+        sorted_indices_to_remove[..., :max(self.min_tokens_to_keep, 1)] = False
 
         # Normalize the probabilities of the remaining words
-        if is_torch_xpu_available():
-            prob_topk = torch.softmax(sorted_logits, dim=0).to("xpu")
-            prev_i = torch.multinomial(prob_topk, num_samples=1, replacement=True).to("xpu")
+        sorted_logits = sorted_logits.float().masked_fill(sorted_indices_to_remove, self.filter_value)
+        prob_topk = torch.softmax(sorted_logits, dim=-1)
+        if self.generators is None:
+            prev_i = torch.multinomial(prob_topk, num_samples=1, replacement=True)
         else:
-            prob_topk = torch.softmax(sorted_logits, dim=0).to('cuda')
-            prev_i = torch.multinomial(prob_topk, num_samples=1, replacement=True).to('cuda')
+            prev_i = self.generators.multinomial(prob_topk)
 
-        observed_surprise = -math.log2(prob_topk[prev_i])
+        observed_surprise = -torch.log2(torch.gather(prob_topk, -1, prev_i))
         self.e = observed_surprise - self.mirostat_tau
 
         # Update mu using the learning rate and error
-        self.mu -= self.mirostat_eta * self.e
+        self.mu = self.mu - self.mirostat_eta * self.e
+
+        # Keep only the sampled token in every row
+        prev_token = torch.gather(sorted_indices, -1, prev_i)
+        indices_to_remove = torch.ones_like(scores, dtype=torch.bool)
+        indices_to_remove.scatter_(1, prev_token, False)
+        scores = scores.masked_fill(indices_to_remove, self.filter_value)
+        return scores
 
-        sorted_indices_to_remove = torch.ones_like(scores[0], dtype=torch.bool)
-        sorted_indices_to_remove[prev_i] = False
 
-        indices_to_remove = sorted_indices_to_remove.unsqueeze(0).scatter(1, sorted_indices.unsqueeze(0), sorted_indices_to_remove.unsqueeze(0))
+class TopKLogitsWarperCustom(TopKLogitsWarper):
+    '''
+    The original Transformers top-k warper that reuses the shared sorted logits when they are available.
+    '''
+
+    keeps_order = True
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return self.warp_candidates(input_ids, SamplerCandidates(scores))
+
+    def warp_candidates(self, input_ids: torch.LongTensor, candidates: SamplerCandidates) -> torch.FloatTensor:
+        scores = candidates.scores
+        if torch.is_tensor(self.top_k):
+            # Per-row k, 0 keeps every token
+            top_k = torch.where(self.top_k > 0, self.top_k, scores.size(-1)).clamp(1, scores.size(-1))
+            threshold = torch.gather(candidates.sorted_logits, -1, top_k - 1)
+            return scores.masked_fill(scores < threshold, self.filter_value)
+
+        top_k = min(self.top_k, scores.size(-1))  # Safety check
+        if candidates.is_sorted:
+            threshold = candidates.sorted_logits[..., top_k - 1, None]
+        else:
+            threshold = torch.topk(scores, top_k)[0][..., -1, None]
+        # Remove all tokens with a probability less than the last token of the top-k
+        indices_to_remove = scores < threshold
         scores = scores.masked_fill(indices_to_remove, self.filter_value)
         return scores
 
 
-class SpyLogitsWarper(LogitsWarper):
+class TopPLogitsWarperCustom(TopPLogitsWarper):
+    '''
+    The original Transformers top-p warper with per-row top_p values.
+    It keeps its own ascending sort: the flipped shared sort puts tied logits in another order,
+    and tied tokens at the cutoff would be kept or removed differently than by the original.
+    '''
+
+    keeps_order = True
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return self.warp_candidates(input_ids, SamplerCandidates(scores))
+
+    def warp_candidates(self, input_ids: torch.LongTensor, candidates: SamplerCandidates) -> torch.FloatTensor:
+        sorted_logits, sorted_indices = torch.sort(candidates.scores, descending=False)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+
+        # Remove tokens with cumulative top_p above the threshold (token with 0 are kept)
+        sorted_indices_to_remove = cumulative_probs <= (1 - self.top_p)
+        if torch.is_tensor(self.top_p):
+            # Rows with top_p = 1 keep even the tokens with zero probability
+            sorted_indices_to_remove &= self.top_p < 1.0
+        # Keep at least min_tokens_to_keep
+        sorted_indices_to_remove[..., -self.min_tokens_to_keep :] = 0
+
+        # scatter sorted tensors to original indexing
+        indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+        scores = candidates.scores.masked_fill(indices_to_remove, self.filter_value)
+        return scores
+
+
+class SharedCandidatesLogitsWarper(LogitsWarper):
+    '''
+    Runs a chain of warpers over candidates that are sorted at most once per step.
+    Warpers with `warp_candidates` reuse the shared sort and probabilities,
+    the sort is redone only after a warper that can change the order of tokens.
+    With `candidate_pool_size` the chain works only on the top-N tokens and scatters them back at the end.
+    The pool is exact only for warpers that compare logits of the pool with each other,
+    the ones that normalize probabilities over the pool see a different distribution than over the full vocabulary.
+    '''
+
+    # Transformers warpers that only rescale scores or cut the tail of the sorted distribution
+    order_preserving_warpers = ('EpsilonLogitsWarper', 'EtaLogitsWarper', 'LogitNormalization')
+
+    # Warpers that give the same result on the pool as on the full vocabulary if the pool holds every kept token
+    pool_exact_warpers = (
+        'MinPLogitSpaceWarper',
+        'MinPLogitsWarper',
+        'TemperatureLogitsWarper',
+        'TemperatureLogitsWarperCustom',
+        'TopKLogitsWarper',
+        'TopKLogitsWarperCustom',
+    )
+
+    def __init__(self, warpers, candidate_pool_size: int = None, filter_value: float = -float("Inf")):
+        if candidate_pool_size is not None and candidate_pool_size < 1:
+            raise ValueError(f"`candidate_pool_size` has to be a positive integer, but is {candidate_pool_size}")
+        self.warpers = warpers
+        self.candidate_pool_size = candidate_pool_size
+        self.filter_value = filter_value
+        self.pool_exact = all(self.is_pool_exact(warper) for warper in warpers)
+
+    def is_pool_exact(self, warper):
+        if warper.__class__.__name__ == 'QuadraticSamplingLogitsWarper':
+            # Relative to the top logit, tail tokens stay below the pool only with a monotonic curve
+            return warper.keeps_order
+        return warper.__class__.__name__ in self.pool_exact_warpers
+
+    def reset(self):
+        reset_logits_processors(self.warpers)
+
+    def observe(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        for warper in self.warpers:
+            if hasattr(warper, 'observe'):
+                warper.observe(input_ids, scores)
+
+    def keeps_order(self, warper):
+        if warper.__class__.__name__ in self.order_preserving_warpers:
+            return True
+        return getattr(warper, 'keeps_order', False)
+
+    def warp_candidates(self, input_ids: torch.LongTensor, candidates: SamplerCandidates) -> torch.FloatTensor:
+        for warper in self.warpers:
+            if hasattr(warper, 'warp_candidates'):
+                scores = warper.warp_candidates(input_ids, candidates)
+            else:
+                scores = warper(input_ids, candidates.scores)
+            candidates = candidates.update(scores, keeps_order=self.keeps_order(warper))
+        return candidates.scores
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.candidate_pool_size is None or self.candidate_pool_size >= scores.size(-1):
+            return self.warp_candidates(input_ids, SamplerCandidates(scores))
+
+        # Run the chain only on the top candidates, they are already sorted by topk
+        pool_scores, pool_indices = torch.topk(scores, self.candidate_pool_size, dim=-1)
+        pool_order = torch.arange(self.candidate_pool_size, device=scores.device).expand_as(pool_indices)
+        pool_scores = self.warp_candidates(input_ids, SamplerCandidates(pool_scores, pool_order, pool_indices, scores.size(-1)))
+
+        # The pool was too small to be exact if its last candidate survived the chain,
+        # with warpers that normalize over the pool no row is exact
+        if self.pool_exact:
+            global_pool_stats["inexact_rows"] += (pool_scores[..., -1] != self.filter_value).sum()
+        else:
+            global_pool_stats["inexact_rows"] += scores.shape[0]
+        global_pool_stats["rows"] += scores.shape[0]
+
+        scores = torch.full_like(scores, self.filter_value).scatter(1, pool_indices, pool_scores)
+        return scores
+
+
+class SuffixAutomaton:
+    '''
+    Online suffix automaton of a token sequence, amortized O(1) per appended token.
+    '''
+
     def __init__(self):
-        pass
+        self.length = [0]
+        self.link = [-1]
+        self.next = [{}]
+        self.last = 0
+
+    def extend(self, token: int):
+        cur = len(self.length)
+        self.length.append(self.length[self.last] + 1)
+        self.link.append(-1)
+        self.next.append({})
+        p = self.last
+        while p != -1 and token not in self.next[p]:
+            self.next[p][token] = cur
+            p = self.link[p]
+        if p == -1:
+            self.link[cur] = 0
+        else:
+            q = self.next[p][token]
+            if self.length[p] + 1 == self.length[q]:
+                self.link[cur] = q
+            else:
+                clone = len(self.length)
+                self.length.append(self.length[p] + 1)
+                self.link.append(self.link[q])
+                self.next.append(dict(self.next[q]))
+                while p != -1 and self.next[p].get(token) == q:
+                    self.next[p][token] = clone
+                    p = self.link[p]
+                self.link[q] = clone
+                self.link[cur] = clone
+        self.last = cur
+
+    def match_lengths(self, min_length: int):
+        '''
+        For every token that continues an earlier occurrence of a suffix of the sequence,
+        returns the length of the longest such suffix, if it is at least `min_length`.
+        Walks the suffix links of the repeated suffixes, so it costs their number plus their transitions,
+        which is small for ordinary text, but can grow with the context for long repeats.
+        '''
+        match_lengths = dict()
+        state = self.link[self.last]
+        while state > 0 and self.length[state] >= min_length:
+            for token in self.next[state]:
+                if token >= 0 and token not in match_lengths:
+                    match_lengths[token] = self.length[state]
+            state = self.link[state]
+        return match_lengths
+
+
+class DRYLogitsProcessor(LogitsProcessor):
+    '''
+    DRY (Don't Repeat Yourself) penalty for tokens that would continue an n-gram repeat.
+    Every row keeps its own suffix automaton instead of rescanning the context: appending a token is amortized O(1),
+    finding the penalized tokens walks only the suffix links of the repeats that are at least `allowed_length` long.
+    Sequence breakers are replaced with unique symbols, so repeats can not span them.
+    It is a logits processor like the repetition penalty, so it also applies to greedy decoding.
+    '''
+
+    def __init__(self, multiplier: float, base: float, allowed_length: int, sequence_breakers):
+        if not (multiplier > 0):
+            raise ValueError(f"`dry_multiplier` has to be strictly positive, but is {multiplier}")
+        if not (base > 1.0):
+            raise ValueError(f"`dry_base` has to be greater than 1, but is {base}")
+        if allowed_length < 1:
+            raise ValueError(f"`dry_allowed_length` has to be a positive integer, but is {allowed_length}")
+
+        self.multiplier = multiplier
+        self.base = base
+        self.allowed_length = allowed_length
+        self.sequence_breakers = set(sequence_breakers)
+        self.automatons = None
+        self.prompt_lengths = None
+
+    def reset(self):
+        self.automatons = None
+        self.prompt_lengths = None
+
+    def select_rows(self, rows):
+        if self.automatons is not None:
+            self.automatons = [self.automatons[row] for row in rows]
+
+    def append_rows(self, other):
+        if other.automatons is not None:
+            self.automatons = (self.automatons or []) + other.automatons
+
+    def extend(self, automaton: SuffixAutomaton, token: int):
+        if token in self.sequence_breakers:
+            token = -len(automaton.length)
+        automaton.extend(token)
+
+    def update_automatons(self, input_ids: torch.LongTensor):
+        # The state is reset before every generation, so existing automatons are one token behind
+        batch_size = input_ids.shape[0]
+        is_next_step = self.automatons is not None and len(self.automatons) == batch_size
+
+        if not is_next_step:
+            # The left padding is not a part of the context
+            lengths = get_prompt_lengths(self.prompt_lengths, input_ids).tolist()
+            self.automatons = [SuffixAutomaton() for _ in range(batch_size)]
+            for automaton, input_ids_row, length in zip(self.automatons, input_ids.tolist(), lengths):
+                for token in input_ids_row[len(input_ids_row) - length:]:
+                    self.extend(automaton, token)
+            return
+
+        for automaton, token in zip(self.automatons, input_ids[:, -1].tolist()):
+            self.extend(automaton, token)
+
+    def penalty(self, match_length: int) -> float:
+        try:
+            return self.multiplier * self.base ** (match_length - self.allowed_length)
+        except OverflowError:
+            # Very long loops, the continuation is removed completely
+            return float("Inf")
+
+    def penalties(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        self.update_automatons(input_ids)
+        vocab_size = scores.size(-1)
+        rows, tokens, penalties = [], [], []
+        for row, automaton in enumerate(self.automatons):
+            for token, match_length in automaton.match_lengths(self.allowed_length).items():
+                if token < vocab_size:
+                    rows.append(row)
+                    tokens.append(token)
+                    penalties.append(self.penalty(match_length))
+
+        penalty = torch.zeros((scores.shape[0], vocab_size), dtype=scores.dtype, device=scores.device)
+        if tokens:
+            rows = torch.tensor(rows, dtype=torch.long, device=scores.device)
+            tokens = torch.tensor(tokens, dtype=torch.long, device=scores.device)
+            penalties = torch.tensor(penalties, dtype=scores.dtype, device=scores.device)
+            penalty.index_put_((rows, tokens), penalties)
+        return penalty
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return scores - self.penalties(input_ids, scores)
+
+
+class RowGenerators:
+    '''
+    One torch.Generator per batch row, seeded per record.
+    Every row is sampled from its own generator, so the result does not depend on the batch it is in.
+    '''
+
+    def __init__(self, seeds):
+        self.seeds = list(seeds)
+        self.generators = None
+
+    def select_rows(self, rows):
+        self.seeds = [self.seeds[row] for row in rows]
+        if self.generators is not None:
+            self.generators = [self.generators[row] for row in rows]
+
+    def append_rows(self, other):
+        '''Appends the rows of other generators, they continue from the state they are in.'''
+        if self.generators is None and other.generators is not None and self.seeds:
+            device = other.generators[0].device
+            self.generators = [torch.Generator(device=device).manual_seed(seed) for seed in self.seeds]
+        self.seeds = self.seeds + other.seeds
+        if self.generators is not None or other.generators is not None:
+            self.generators = (self.generators or []) + (other.generators or [])
+
+    def multinomial(self, probs: torch.FloatTensor) -> torch.LongTensor:
+        if self.generators is None:
+            self.generators = [torch.Generator(device=probs.device).manual_seed(seed) for seed in self.seeds]
+        return torch.cat([
+            torch.multinomial(row_probs, num_samples=1, generator=generator)
+            for row_probs, generator in zip(probs.split(1), self.generators)
+        ])
+
+
+class SeededSamplingLogitsWarper(LogitsWarper):
+    '''
+    Samples the next token of every row with its own generator and masks all other tokens,
+    so the sampling step of `generate` can only pick that token.
+    Pass it to `generate` in `logits_processor`, the patched chains put it after all warpers
+    and give its generators to the warpers that sample on their own, like Mirostat.
+    '''
+
+    def __init__(self, seeds, filter_value: float = -float("Inf")):
+        self.generators = RowGenerators(seeds)
+        self.filter_value = filter_value
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        next_tokens = self.generators.multinomial(torch.softmax(scores.float(), dim=-1))
+        indices_to_remove = torch.ones_like(scores, dtype=torch.bool).scatter_(1, next_tokens, False)
+        return scores.masked_fill(indices_to_remove, self.filter_value)
+
+
+class RowSamplerParams(LogitsProcessor):
+    '''
+    Per-row values of sampler parameters for one generate call, like a temperature for every row.
+    Pass it to `generate` in `logits_processor` with a config from `merge_row_configs`,
+    the patched warper chain gets the values as [batch, 1] tensors. It doesn't change scores itself.
+    '''
+
+    def __init__(self, params):
+        self.params = params
+
+    def tensors(self, device):
+        return {
+            name: torch.tensor(values, dtype=torch.long if name == "top_k" else torch.float32, device=device).unsqueeze(1)
+            for name, values in self.params.items()
+        }
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        global global_scores
-        global_scores = scores
+        return scores
+
+
+class TopKCaptureLogitsProcessor(LogitsProcessor):
+    '''
+    Records top-k raw logits and top-k final scores of every step into preallocated buffers,
+    so the memory grows with k instead of the vocabulary size.
+    Pass it to `generate` in `logits_processor`, the patched chains put the raw logits capture
+    before all processors and `scores_capture` after all warpers.
+    The final scores of the last step stay in `last_scores` for stopping criteria.
+    '''
+
+    def __init__(self, k: int, max_steps: int):
+        self.k = k
+        self.max_steps = max_steps
+        self.logits_values = None
+        self.logits_indices = None
+        self.scores_values = None
+        self.scores_indices = None
+        self.logits_step = 0
+        self.scores_step = 0
+        self.last_scores = None
+        self.scores_capture = TopKScoresCaptureLogitsProcessor(self)
+
+    @property
+    def num_steps(self):
+        return self.scores_step
+
+    def allocate(self, scores: torch.FloatTensor):
+        shape = (self.max_steps, scores.shape[0], min(self.k, scores.shape[-1]))
+        self.logits_values = torch.empty(shape, dtype=scores.dtype, device=scores.device)
+        self.logits_indices = torch.empty(shape, dtype=torch.int32, device=scores.device)
+        self.scores_values = torch.empty(shape, dtype=scores.dtype, device=scores.device)
+        self.scores_indices = torch.empty(shape, dtype=torch.int32, device=scores.device)
+
+    def record(self, values: torch.FloatTensor, indices: torch.LongTensor, step: int, scores: torch.FloatTensor):
+        if step < self.max_steps:
+            top_values, top_indices = torch.topk(scores, values.shape[-1], dim=-1)
+            values[step] = top_values
+            indices[step] = top_indices
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.logits_values is None:
+            self.allocate(scores)
+        self.record(self.logits_values, self.logits_indices, self.logits_step, scores)
+        self.logits_step += 1
+        return scores
+
+
+class TopKScoresCaptureLogitsProcessor(LogitsProcessor):
+    def __init__(self, capture: TopKCaptureLogitsProcessor):
+        self.capture = capture
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        capture = self.capture
+        capture.record(capture.scores_values, capture.scores_indices, capture.scores_step, scores)
+        capture.scores_step += 1
+        capture.last_scores = scores
         return scores
 
 
 class RepetitionPenaltyLogitsProcessorWithRange(LogitsProcessor):
     '''
-    Copied from the transformers library
+    Repetition, presence and frequency penalties over the last `_range` tokens.
+    Keeps a [batch, vocab] table of token counts in the window and updates it incrementally:
+    the new token is added and the token that left the window is removed on every step.
+    The length of every row is tracked, so the left padding of a static batch is never counted
+    and rows that joined a continuous batch with a shorter history never remove padding from their window.
     '''
 
     def __init__(self, penalty: float, presence_penalty: float, frequency_penalty: float, _range: int):
@@ -291,29 +939,315 @@ class RepetitionPenaltyLogitsProcessorWithRange(LogitsProcessor):
         self.presence_penalty = presence_penalty
         self.frequency_penalty = frequency_penalty
         self._range = _range
+        self.counts = None
+        self.lengths = None
+        self.prompt_lengths = None
+
+    def reset(self):
+        self.counts = None
+        self.lengths = None
+        self.prompt_lengths = None
+
+    def select_rows(self, rows):
+        if self.counts is not None:
+            self.counts, self.lengths = select_state_rows(self.counts, rows), select_state_rows(self.lengths, rows)
+
+    def append_rows(self, other):
+        if other.counts is not None:
+            self.counts, self.lengths = append_state_rows(self.counts, other.counts), append_state_rows(self.lengths, other.lengths)
+
+    def update_counts(self, input_ids: torch.LongTensor, vocab_size: int):
+        batch_size, seq_len = input_ids.shape
+        # The state is reset before every generation, so existing counts are one token behind
+        is_next_step = self.counts is not None and self.counts.shape == (batch_size, vocab_size)
+
+        if not is_next_step:
+            # A new sequence, count all the tokens in the window, but not the left padding
+            lengths = get_prompt_lengths(self.prompt_lengths, input_ids)
+            window_ids = input_ids[:, -self._range:]
+            window_size = window_ids.shape[1]
+            positions = torch.arange(window_size, device=input_ids.device)
+            is_token = positions[None, :] >= window_size - lengths[:, None]
+            self.counts = torch.zeros((batch_size, vocab_size), dtype=torch.int32, device=input_ids.device)
+            self.counts.scatter_add_(1, window_ids, is_token.int())
+            self.lengths = lengths[:, None].int()
+            return
+
+        ones = torch.ones((batch_size, 1), dtype=torch.int32, device=input_ids.device)
+        self.counts.scatter_add_(1, input_ids[:, -1:], ones)
+        self.lengths += 1
+        if 0 < self._range < seq_len:
+            left_ids = input_ids[:, -self._range - 1: -self._range]
+            self.counts.scatter_add_(1, left_ids, -(self.lengths > self._range).int())
+
+    def observe(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        self.update_counts(input_ids, scores.size(-1))
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        input_ids = input_ids[:, -self._range:]
+        # The counts are updated outside when the processor runs inside a compiled graph
+        if input_ids is not None:
+            self.observe(input_ids, scores)
+        is_present = self.counts > 0
+
+        # multiplicative repetition penalty
+        # if score < 0 then repetition penalty has to be multiplied to reduce the previous token probability
+        penalized_scores = torch.where(scores < 0, scores * self.penalty, scores / self.penalty)
+        scores = torch.where(is_present, penalized_scores, scores)
+
+        # presence_penalty and frequency_penalty
+        raw_presence_penalty = is_present.to(scores.dtype)
+        raw_frequency_penalty = self.counts.to(scores.dtype)
+        additive_penalty = raw_presence_penalty * self.presence_penalty + raw_frequency_penalty * self.frequency_penalty
+        scores = scores - additive_penalty
 
-        # We loop here because torch.unique() needs to process each row separately in the
-        # case that batch_size > 1.
-        for input_ids_row, scores_row in zip(input_ids, scores):
-            unique_ids, counts = torch.unique(input_ids_row, return_counts=True)
-            score = torch.gather(scores_row, 0, unique_ids)
+        return scores
 
-            # multiplicative repetition penalty
-            # if score < 0 then repetition penalty has to be multiplied to reduce the previous token probability
-            score = torch.where(score < 0, score * self.penalty, score / self.penalty)
-            scores_row.scatter_(0, unique_ids, score)
 
-            # presence_penalty and frequency_penalty
-            raw_presence_penalty = (counts > 0).to(scores.dtype)
-            raw_frequency_penalty = counts.to(scores.dtype)
-            additive_penalty = raw_presence_penalty * self.presence_penalty + raw_frequency_penalty * self.frequency_penalty
-            scores_row.scatter_add_(0, unique_ids, -additive_penalty)
+class CompiledLogitsProcessor(LogitsProcessor):
+    '''
+    Runs a list of processors as one torch.compile graph with static shapes.
+    Stateful processors update their state from input_ids in `observe` outside of the graph,
+    the graph itself depends only on the scores.
+    If any processor needs host syncs or data dependent shapes, the whole list runs eagerly
+    and the offending processors are listed in `fallbacks`.
+    '''
 
+    compile_friendly_processors = (
+        'DynamicTemperatureLogitsWarper',
+        'EpsilonLogitSpaceWarper',
+        'EpsilonLogitsWarper',
+        'EtaLogitSpaceWarper',
+        'EtaLogitsWarper',
+        'LogitNormalization',
+        'MinPLogitSpaceWarper',
+        'MinPLogitsWarper',
+        'MirostatLogitsWarper',
+        'QuadraticSamplingLogitsWarper',
+        'RepetitionPenaltyLogitsProcessorWithRange',
+        'TailFreeLogitsWarper',
+        'TemperatureLogitsWarper',
+        'TemperatureLogitsWarperCustom',
+        'TopALogitSpaceWarper',
+        'TopALogitsWarper',
+        'TopKLogitsWarper',
+        'TopKLogitsWarperCustom',
+        'TopPLogitsWarper',
+        'TopPLogitsWarperCustom',
+        'TypicalLogitsWarper',
+    )
+
+    def __init__(self, processors):
+        self.processors = processors
+        self.fallbacks = self.find_fallbacks(processors)
+        self.compiled_call = None
+        self.eager = False
+        if not self.fallbacks:
+            # Every cached chain is a separate graph of the same function
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+            self.compiled_call = torch.compile(self.call_processors, fullgraph=True, dynamic=False)
+
+    def find_fallbacks(self, processors):
+        fallbacks = []
+        for processor in processors:
+            if isinstance(processor, SharedCandidatesLogitsWarper):
+                fallbacks += self.find_fallbacks(processor.warpers)
+            elif processor.__class__.__name__ not in self.compile_friendly_processors:
+                fallbacks.append(processor.__class__.__name__)
+        return fallbacks
+
+    def reset(self):
+        reset_logits_processors(self.processors)
+
+    def call_processors(self, scores: torch.FloatTensor) -> torch.FloatTensor:
+        for processor in self.processors:
+            scores = processor(None, scores)
         return scores
 
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.compiled_call is None or self.eager:
+            for processor in self.processors:
+                scores = processor(input_ids, scores)
+            return scores
+
+        for processor in self.processors:
+            if hasattr(processor, 'observe'):
+                processor.observe(input_ids, scores)
+        # The first step gets a strided slice of the prompt logits, keep the layout static
+        return self.compiled_call(scores.contiguous())
+
+
+def reset_logits_processors(processors):
+    for processor in processors:
+        if hasattr(processor, 'reset'):
+            processor.reset()
+
+
+def select_state_rows(state: torch.Tensor, rows) -> torch.Tensor:
+    return state.index_select(0, torch.tensor(rows, dtype=torch.long, device=state.device))
+
+
+def append_state_rows(state: torch.Tensor, other_state: torch.Tensor) -> torch.Tensor:
+    return other_state if state is None else torch.cat((state, other_state))
+
+
+def select_processor_rows(processors, rows):
+    '''Keeps the per-row state of the given rows, in the given order, like when sequences leave a continuous batch.'''
+    for processor in processors:
+        if isinstance(processor, SharedCandidatesLogitsWarper):
+            select_processor_rows(processor.warpers, rows)
+        elif isinstance(processor, CompiledLogitsProcessor):
+            select_processor_rows(processor.processors, rows)
+        elif hasattr(processor, 'select_rows'):
+            processor.select_rows(rows)
+
+
+def append_processor_rows(processors, other_processors):
+    '''Appends the per-row state of a chain built from the same config, like the chain of sequences that join a batch.'''
+    for processor, other in zip(processors, other_processors):
+        if isinstance(processor, SharedCandidatesLogitsWarper):
+            append_processor_rows(processor.warpers, other.warpers)
+        elif isinstance(processor, CompiledLogitsProcessor):
+            append_processor_rows(processor.processors, other.processors)
+        elif hasattr(processor, 'append_rows'):
+            processor.append_rows(other)
+
+
+def get_cached_chain(cache, key, build):
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    cache[key] = build()
+    while len(cache) > MAX_CACHED_CHAINS:
+        cache.popitem(last=False)
+    return cache[key]
+
+
+def release_cached_chains():
+    '''Drops the per-run state of all cached chains, like repetition counts, DRY automatons and generators.'''
+    chains = list(logits_warper_cache.values())
+    for model_cache in list(logits_processor_cache.values()):
+        chains += list(model_cache.values())
+    for chain in chains:
+        reset_logits_processors(chain)
+        set_sampling_generators(chain, None)
+
+
+def depends_on_prompt_length(generation_config):
+    '''Whether the Transformers processors of the config are built for a specific prompt length.'''
+    return bool(
+        generation_config.min_new_tokens
+        or generation_config.begin_suppress_tokens
+        or generation_config.exponential_decay_length_penalty is not None
+    )
+
+
+def set_sampling_generators(processors, generators):
+    '''Hands per-row generators to the warpers that sample on their own, returns whether there were any'''
+    found = False
+    for processor in processors:
+        if isinstance(processor, SharedCandidatesLogitsWarper):
+            found |= set_sampling_generators(processor.warpers, generators)
+        elif isinstance(processor, CompiledLogitsProcessor):
+            # Sampling with a generator per row is a loop of host calls, it can't be in the graph
+            processor.eager = set_sampling_generators(processor.processors, generators) and generators is not None
+            found |= processor.eager
+        elif hasattr(processor, 'generators'):
+            processor.generators = generators
+            found = True
+    return found
+
+
+def get_prompt_lengths(prompt_lengths, input_ids: torch.LongTensor) -> torch.LongTensor:
+    '''Lengths of the left padded prompts without the padding, all of input_ids if they are not known.'''
+    batch_size, seq_len = input_ids.shape
+    if prompt_lengths is None:
+        return torch.full((batch_size,), seq_len, dtype=torch.long, device=input_ids.device)
+    prompt_lengths = prompt_lengths.to(input_ids.device)
+    # Transformers expands the batch for several return sequences or beams after the processors are built
+    if len(prompt_lengths) != batch_size:
+        prompt_lengths = prompt_lengths.repeat_interleave(batch_size // len(prompt_lengths))
+    return prompt_lengths
+
+
+def set_prompt_lengths(processors, prompt_lengths):
+    '''Hands the unpadded prompt lengths of a static batch to the processors that look at the context.'''
+    for processor in processors:
+        if isinstance(processor, SharedCandidatesLogitsWarper):
+            set_prompt_lengths(processor.warpers, prompt_lengths)
+        elif isinstance(processor, CompiledLogitsProcessor):
+            set_prompt_lengths(processor.processors, prompt_lengths)
+        elif hasattr(processor, 'prompt_lengths'):
+            processor.prompt_lengths = prompt_lengths
+
+
+def set_row_sampler_params(processors, params):
+    for processor in processors:
+        if isinstance(processor, SharedCandidatesLogitsWarper):
+            set_row_sampler_params(processor.warpers, params)
+        elif isinstance(processor, CompiledLogitsProcessor):
+            set_row_sampler_params(processor.processors, params)
+        else:
+            for name, values in params.items():
+                if hasattr(processor, name):
+                    setattr(processor, name, values)
+
+
+def merge_row_configs(generation_configs):
+    '''
+    One config for a batch that mixes rows of several configs, and the names of the parameters that differ between them.
+    Only ROW_SAMPLER_PARAMS can differ. A parameter that is on for some rows is on in the merged config,
+    so its warper is in the chain, the other rows get the value that turns it off.
+    '''
+    def structure(generation_config):
+        return {k: v for k, v in generation_config.to_dict().items() if k not in ROW_SAMPLER_PARAMS}
+
+    base = generation_configs[0]
+    for generation_config in generation_configs[1:]:
+        if structure(generation_config) != structure(base):
+            diff = sorted(k for k, v in structure(generation_config).items() if structure(base).get(k) != v)
+            raise ValueError(f"Generation configs can only differ in {', '.join(ROW_SAMPLER_PARAMS)}, but differ in {', '.join(diff)}")
+
+    merged = copy.deepcopy(base)
+    row_params = []
+    for name, off_value in ROW_SAMPLER_PARAMS.items():
+        values = [row_sampler_param(c, name) for c in generation_configs]
+        if len(set(values)) == 1:
+            continue
+        setattr(merged, name, next(v for v in values if v != off_value))
+        row_params.append(name)
+    return merged, row_params
+
+
+def row_sampler_param(generation_config, name):
+    value = getattr(generation_config, name)
+    return ROW_SAMPLER_PARAMS[name] if value is None else value
+
+
+def compile_logits_processors(processors, name):
+    compiled = CompiledLogitsProcessor(processors)
+    if compiled.fallbacks:
+        print(f"Sampler chain {name} run eagerly because of: {', '.join(compiled.fallbacks)}")
+    return compiled
+
+
+def generation_config_fingerprint(generation_config):
+    # generate sets max_length from the prompt length, only the stopping criteria use it
+    data = {k: v for k, v in generation_config.to_dict().items() if k != "max_length"}
+    return json.dumps(data, sort_keys=True, default=str)
+
+
+def resolve_sampler_priority(generation_config):
+    sampler_priority = list(generation_config.sampler_priority)
+
+    # Handle temperature_last
+    if generation_config.temperature_last:
+        for param_name in ['temperature', 'dynamic_temperature', 'quadratic_sampling']:
+            if param_name in sampler_priority:
+                index = sampler_priority.index(param_name)
+                sampler_priority.append(sampler_priority.pop(index))
+
+    return sampler_priority
+
 
 def get_logits_warper_patch(self, generation_config):
 
@@ -321,16 +1255,70 @@ def get_logits_warper_patch(self, generation_config):
     if isinstance(generation_config.temperature, int):
         generation_config.temperature = float(generation_config.temperature)  # Must be float
 
+    # The capture of the final scores is registered for this generate call by get_logits_processor_patch
+    capture = getattr(generation_config, 'top_k_capture', None)
+    if capture is not None:
+        del generation_config.top_k_capture
+    sampling = getattr(generation_config, 'seeded_sampling', None)
+    if sampling is not None:
+        del generation_config.seeded_sampling
+    row_params = getattr(generation_config, 'row_sampler_params', None)
+    if row_params is not None:
+        del generation_config.row_sampler_params
+
+    # Build the chain once per config, stateful warpers are reset before every generation.
+    # Chains with per-row parameters are kept apart, their values are replaced on every call.
+    fingerprint = generation_config_fingerprint(generation_config)
+    if row_params is not None:
+        fingerprint = json.dumps([fingerprint, sorted(row_params.params)])
+    warpers = get_cached_chain(logits_warper_cache, fingerprint, lambda: build_logits_warper(self, generation_config))
+    reset_logits_processors(warpers)
+    if row_params is not None:
+        set_row_sampler_params(warpers, row_params.tensors(self.device))
+    set_sampling_generators(warpers, sampling.generators if sampling is not None else None)
+
+    if capture is not None:
+        warpers = LogitsProcessorList(list(warpers) + [capture.scores_capture])
+    if sampling is not None:
+        warpers = LogitsProcessorList(list(warpers) + [sampling])
+    return warpers
+
+
+def build_logits_warper(self, generation_config):
+
     # Get the original warpers
     warpers = self._get_logits_warper_old(generation_config)
 
-    # Replace temperature with our modified class.
-    # Currently, it behaves identically to the original.
+    # Replace temperature, top-k and top-p with our modified classes.
+    # Currently, they behave identically to the original.
     for i in range(len(warpers)):
         if warpers[i].__class__.__name__ == 'TemperatureLogitsWarper':
             warpers[i] = TemperatureLogitsWarperCustom(
                 generation_config.temperature,
             )
+        elif warpers[i].__class__.__name__ == 'TopKLogitsWarper':
+            warpers[i] = TopKLogitsWarperCustom(
+                top_k=warpers[i].top_k,
+                filter_value=warpers[i].filter_value
+            )
+        elif warpers[i].__class__.__name__ == 'EpsilonLogitsWarper' and generation_config.logit_space_truncation:
+            warpers[i] = EpsilonLogitSpaceWarper(
+                epsilon=warpers[i].epsilon,
+                filter_value=warpers[i].filter_value,
+                min_tokens_to_keep=warpers[i].min_tokens_to_keep
+            )
+        elif warpers[i].__class__.__name__ == 'EtaLogitsWarper' and generation_config.logit_space_truncation:
+            warpers[i] = EtaLogitSpaceWarper(
+                epsilon=float(warpers[i].epsilon),
+                filter_value=warpers[i].filter_value,
+                min_tokens_to_keep=warpers[i].min_tokens_to_keep
+            )
+        elif warpers[i].__class__.__name__ == 'TopPLogitsWarper':
+            warpers[i] = TopPLogitsWarperCustom(
+                top_p=warpers[i].top_p,
+                filter_value=warpers[i].filter_value,
+                min_tokens_to_keep=warpers[i].min_tokens_to_keep
+            )
 
     # Add custom warpers
     warpers_to_add = LogitsProcessorList()
@@ -343,17 +1331,19 @@ def get_logits_warper_patch(self, generation_config):
             )
         )
 
+    top_a_class = TopALogitSpaceWarper if generation_config.logit_space_truncation else TopALogitsWarper
     if generation_config.top_a is not None and 0.0 < generation_config.top_a <= 1.0:
         warpers_to_add.append(
-            TopALogitsWarper(
+            top_a_class(
                 top_a=generation_config.top_a,
                 min_tokens_to_keep=min_tokens_to_keep
             )
         )
 
+    min_p_class = MinPLogitSpaceWarper if generation_config.logit_space_truncation else MinPLogitsWarper
     if generation_config.min_p is not None and 0.0 < generation_config.min_p <= 1.0:
         warpers_to_add.append(
-            MinPLogitsWarper(
+            min_p_class(
                 min_p=generation_config.min_p,
                 min_tokens_to_keep=min_tokens_to_keep
             )
@@ -394,30 +1384,26 @@ def get_logits_warper_patch(self, generation_config):
     warpers += warpers_to_add
 
     # Sort the samplers.
-    sampler_priority = generation_config.sampler_priority
-
-    # Handle temperature_last
-    if generation_config.temperature_last:
-        for param_name in ['temperature', 'dynamic_temperature', 'quadratic_sampling']:
-            if param_name in sampler_priority:
-                if param_name in sampler_priority:
-                    index = sampler_priority.index(param_name)
-                    sampler_priority.append(sampler_priority.pop(index))
-                else:
-                    sampler_priority.append(param_name)
+    sampler_priority = resolve_sampler_priority(generation_config)
 
     class_name_to_nickname = {
         'DynamicTemperatureLogitsWarper': 'dynamic_temperature',
         'EpsilonLogitsWarper': 'epsilon_cutoff',
+        'EpsilonLogitSpaceWarper': 'epsilon_cutoff',
         'EtaLogitsWarper': 'eta_cutoff',
+        'EtaLogitSpaceWarper': 'eta_cutoff',
         'MinPLogitsWarper': 'min_p',
+        'MinPLogitSpaceWarper': 'min_p',
         'MirostatLogitsWarper': 'mirostat',
         'QuadraticSamplingLogitsWarper': 'quadratic_sampling',
         'TailFreeLogitsWarper': 'tfs',
         'TemperatureLogitsWarperCustom': 'temperature',
         'TopALogitsWarper': 'top_a',
+        'TopALogitSpaceWarper': 'top_a',
         'TopKLogitsWarper': 'top_k',
+        'TopKLogitsWarperCustom': 'top_k',
         'TopPLogitsWarper': 'top_p',
+        'TopPLogitsWarperCustom': 'top_p',
         'TypicalLogitsWarper': 'typical_p'
     }
 
@@ -433,33 +1419,110 @@ def get_logits_warper_patch(self, generation_config):
 
     # Sort the list using the custom key function
     warpers = sorted(warpers, key=custom_sort_key)
+
+    # Share one sort of the candidates between all the warpers
+    warpers = [SharedCandidatesLogitsWarper(warpers, candidate_pool_size=generation_config.candidate_pool_size)]
     if normalize is not None:
         warpers.append(normalize)
 
-    warpers.append(SpyLogitsWarper())
+    if generation_config.compile_sampler_chain:
+        warpers = [compile_logits_processors(warpers, "warpers")]
+
     warpers = LogitsProcessorList(warpers)
     return warpers
 
 
 def get_logits_processor_patch(self, **kwargs):
-    repetition_penalty = kwargs['generation_config'].repetition_penalty
-    presence_penalty = kwargs['generation_config'].presence_penalty
-    frequency_penalty = kwargs['generation_config'].frequency_penalty
-    repetition_penalty_range = kwargs['generation_config'].repetition_penalty_range
+    generation_config = kwargs['generation_config']
+
+    # Top-k captures go around the whole chain and seeded sampling goes after the warpers
+    custom_processors = kwargs.get('logits_processor') or LogitsProcessorList()
+    captures = [p for p in custom_processors if isinstance(p, TopKCaptureLogitsProcessor)]
+    samplings = [p for p in custom_processors if isinstance(p, SeededSamplingLogitsWarper)]
+    row_params = [p for p in custom_processors if isinstance(p, RowSamplerParams)]
+    kwargs['logits_processor'] = LogitsProcessorList([p for p in custom_processors if p not in captures + samplings + row_params])
+
+    # Processors that depend on anything but the model, the config and the prompt length are not cached
+    is_cacheable = (
+        kwargs.get('prefix_allowed_tokens_fn') is None
+        and not kwargs.get('logits_processor')
+        and kwargs.get('negative_prompt_ids') is None
+        and generation_config.guidance_scale in (None, 1)
+        and generation_config.encoder_repetition_penalty in (None, 1.0)
+        and not generation_config.encoder_no_repeat_ngram_size
+    )
+    if not is_cacheable:
+        processors = build_logits_processor(self, **kwargs)
+    else:
+        key = generation_config_fingerprint(generation_config)
+        if depends_on_prompt_length(generation_config):
+            key = (key, kwargs.get('input_ids_seq_length'))
+        model_cache = logits_processor_cache.setdefault(self, OrderedDict())
+        processors = get_cached_chain(model_cache, key, lambda: build_logits_processor(self, **kwargs))
+        reset_logits_processors(processors)
+
+    # Padding is a part of input_ids, the penalties over the context have to skip it
+    attention_mask = (kwargs.get('model_kwargs') or {}).get('attention_mask')
+    set_prompt_lengths(processors, attention_mask.sum(dim=-1) if attention_mask is not None else None)
+
+    for capture in captures:
+        processors = LogitsProcessorList([capture] + list(processors))
+        if generation_config.do_sample:
+            generation_config.top_k_capture = capture
+        else:
+            processors.append(capture.scores_capture)
+    # Greedy search doesn't sample
+    if samplings and generation_config.do_sample:
+        generation_config.seeded_sampling = samplings[-1]
+    if row_params and generation_config.do_sample:
+        generation_config.row_sampler_params = row_params[-1]
+    return processors
+
+
+def build_logits_processor(self, **kwargs):
+    generation_config = kwargs['generation_config']
+    repetition_penalty = generation_config.repetition_penalty
+    presence_penalty = generation_config.presence_penalty
+    frequency_penalty = generation_config.frequency_penalty
+    repetition_penalty_range = generation_config.repetition_penalty_range
     do_rep_pen_hijack = (repetition_penalty > 1) or (presence_penalty != 0) or (frequency_penalty != 0)
     if do_rep_pen_hijack:
-        kwargs['generation_config'].repetition_penalty = 1.1  # Set to value > 1 to ensure RepetitionPenaltyLogitsProcessor is created
+        generation_config.repetition_penalty = 1.1  # Set to value > 1 to ensure RepetitionPenaltyLogitsProcessor is created
 
     result = self._get_logits_processor_old(**kwargs)
+    generation_config.repetition_penalty = repetition_penalty
 
     if do_rep_pen_hijack:
         for i in range(len(result)):
             if result[i].__class__.__name__ == 'RepetitionPenaltyLogitsProcessor':
                 result[i] = RepetitionPenaltyLogitsProcessorWithRange(repetition_penalty, presence_penalty, frequency_penalty, repetition_penalty_range)
 
+    # DRY penalizes the context like the repetition penalty, so it runs with the processors and also for greedy decoding.
+    # Processors run before every warper, where 'dry' is in the default sampler_priority anyway.
+    if generation_config.dry_multiplier is not None and generation_config.dry_multiplier > 0:
+        result.append(
+            DRYLogitsProcessor(
+                multiplier=generation_config.dry_multiplier,
+                base=generation_config.dry_base,
+                allowed_length=generation_config.dry_allowed_length,
+                sequence_breakers=generation_config.dry_sequence_breakers
+            )
+        )
+
+    if generation_config.compile_sampler_chain and len(result) > 0:
+        result = LogitsProcessorList([compile_logits_processors(result, "processors")])
+
     return result
 
 
+def generate_patch(self, *args, **kwargs):
+    try:
+        return self.generate_old(*args, **kwargs)
+    finally:
+        # Cached chains keep only their configuration between calls, not the tensors of the last batch
+        release_cached_chains()
+
+
 def generation_config_init_patch(self, **kwargs):
     self.__init___old(**kwargs)
     self.min_p = kwargs.pop("min_p", 0.0)
@@ -478,7 +1541,14 @@ def generation_config_init_patch(self, **kwargs):
     self.presence_penalty = kwargs.pop("presence_penalty", 0)
     self.frequency_penalty = kwargs.pop("frequency_penalty", 0)
     self.temperature_last = kwargs.pop("temperature_last", False)
-    self.sampler_priority = kwargs.pop("sampler_priority", ['temperature', 'dynamic_temperature', 'quadratic_sampling', 'top_k', 'top_p', 'typical_p', 'epsilon_cutoff', 'eta_cutoff', 'tfs', 'top_a', 'min_p', 'mirostat'])
+    self.logit_space_truncation = kwargs.pop("logit_space_truncation", False)
+    self.candidate_pool_size = kwargs.pop("candidate_pool_size", None)
+    self.compile_sampler_chain = kwargs.pop("compile_sampler_chain", False)
+    self.dry_multiplier = kwargs.pop("dry_multiplier", 0.0)
+    self.dry_base = kwargs.pop("dry_base", 1.75)
+    self.dry_allowed_length = kwargs.pop("dry_allowed_length", 2)
+    self.dry_sequence_breakers = kwargs.pop("dry_sequence_breakers", ["\n", ":", "\"", "*"])
+    self.sampler_priority = kwargs.pop("sampler_priority", ['dry', 'temperature', 'dynamic_temperature', 'quadratic_sampling', 'top_k', 'top_p', 'typical_p', 'epsilon_cutoff', 'eta_cutoff', 'tfs', 'top_a', 'min_p', 'mirostat'])
 
 
 def hijack_samplers():
@@ -488,5 +1558,8 @@ def hijack_samplers():
     transformers.GenerationMixin._get_logits_processor_old = transformers.GenerationMixin._get_logits_processor
     transformers.GenerationMixin._get_logits_processor = get_logits_processor_patch
 
+    transformers.GenerationMixin.generate_old = transformers.GenerationMixin.generate
+    transformers.GenerationMixin.generate = generate_patch
+
     transformers.GenerationConfig.__init___old = transformers.GenerationConfig.__init__
     transformers.GenerationConfig.__init__ = generation_config_init_patch
@@ -0,0 +1,80 @@
+import json
+from typing import Dict, List
+
+import torch
+from transformers.generation.stopping_criteria import StoppingCriteria
+
+# Text of every token, per tokenizer, computed once per process
+token_strings_cache = dict()
+
+
+def load_stop_strings(stop_strings) -> Dict[str, List[str]]:
+    '''Stop strings per prompt source, as a dict or a path to a JSON file with one.'''
+    if isinstance(stop_strings, str):
+        with open(stop_strings, encoding="utf-8") as r:
+            stop_strings = json.load(r)
+    return {source: list(strings) for source, strings in stop_strings.items() if strings}
+
+
+def get_token_strings(tokenizer) -> List[str]:
+    '''
+    Text that every token adds to the decoded output.
+    Tokens are decoded after an anchor token, so leading spaces are not stripped.
+    Byte fallback tokens of multibyte characters decode to a replacement character.
+    Special tokens add nothing, they are skipped when the output is decoded.
+    '''
+    key = (tokenizer.name_or_path, len(tokenizer))
+    if key not in token_strings_cache:
+        anchor_id = tokenizer.encode("a", add_special_tokens=False)[-1]
+        anchor = tokenizer.decode([anchor_id])
+        token_strings = []
+        for token_id, text in enumerate(tokenizer.batch_decode([[anchor_id, token_id] for token_id in range(len(tokenizer))])):
+            token_strings.append(text[len(anchor):] if text.startswith(anchor) else tokenizer.decode([token_id]))
+        for token_id in tokenizer.all_special_ids:
+            if token_id < len(token_strings):
+                token_strings[token_id] = ""
+        token_strings_cache[key] = token_strings
+    return token_strings_cache[key]
+
+
+class StopStringMatcher:
+    '''
+    Incremental search of stop strings in the generated text of one sequence.
+    Only the last characters that can be a part of a stop string are kept,
+    so every step checks the text of one token instead of decoding the whole output.
+    '''
+
+    def __init__(self, stop_strings: List[str], token_strings: List[str]):
+        self.stop_strings = stop_strings
+        self.token_strings = token_strings
+        self.tail_length = max(len(s) for s in stop_strings) - 1
+        self.tail = ""
+
+    def update(self, token_id: int) -> bool:
+        text = self.tail + self.token_strings[token_id]
+        self.tail = text[-self.tail_length:] if self.tail_length else ""
+        return any(s in text for s in self.stop_strings)
+
+    def reset(self):
+        self.tail = ""
+
+
+class StopStringsCriteria(StoppingCriteria):
+    '''
+    Finishes every row of `generate` as soon as its own stop strings appear, rows without a matcher never stop.
+    The step of the first match of every row is kept in `stop_steps`.
+    '''
+
+    def __init__(self, matchers):
+        self.matchers = matchers
+        self.stop_steps = [None] * len(matchers)
+        self.step = 0
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        token_ids = input_ids[:, -1].tolist()
+        for row, (matcher, token_id) in enumerate(zip(self.matchers, token_ids)):
+            if matcher is not None and self.stop_steps[row] is None and matcher.update(token_id):
+                self.stop_steps[row] = self.step
+        self.step += 1
+        is_done = [stop_step is not None for stop_step in self.stop_steps]
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
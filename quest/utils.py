@@ -1,6 +1,7 @@
 import json
 import os
 import random
+import hashlib
 
 import torch
 import numpy as np
@@ -32,12 +33,56 @@ def set_random_seed(seed):
     torch.backends.cudnn.deterministic = True
 
 
-def gen_batch(records, batch_size):
-    batch_start = 0
-    while batch_start < len(records):
-        batch_end = batch_start + batch_size
-        batch = records[batch_start: batch_end]
-        batch_start = batch_end
+def record_seeds(records, seed):
+    '''
+    A seed for every record derived from the global seed and the record itself,
+    so it doesn't depend on the position of the record in a batch, a shard or a run.
+    Repeated identical records are told apart by their occurrence number.
+    '''
+    occurrences = dict()
+    seeds = []
+    for record in records:
+        key = json.dumps(record, ensure_ascii=False, sort_keys=True)
+        occurrence = occurrences.get(key, 0)
+        occurrences[key] = occurrence + 1
+        digest = hashlib.sha256(f"{seed}\n{occurrence}\n{key}".encode("utf-8")).digest()
+        seeds.append(int.from_bytes(digest[:8], "little") & ((1 << 63) - 1))
+    return seeds
+
+
+def expand_samples(records, num_samples):
+    '''
+    Every record repeated `num_samples` times with its "sample_iteration", and the index of its source record.
+    The iteration is a part of the record, so every sample gets its own seed.
+    '''
+    if num_samples == 1:
+        return records, list(range(len(records)))
+    samples = [{**record, "sample_iteration": iteration} for record in records for iteration in range(num_samples)]
+    source_indices = [index for index in range(len(records)) for _ in range(num_samples)]
+    return samples, source_indices
+
+
+def gen_length_batches(lengths, batch_size, max_batch_tokens=None, sort=True, fits=None):
+    '''
+    Yields batches of indices grouped by length, longest first, so that padding within a batch is minimal.
+    With max_batch_tokens, a batch is also closed when its padded size would exceed the budget.
+    `fits(num_sequences, max_length)` is an extra check of the batch size, it is called lazily for every batch.
+    '''
+    indices = list(range(len(lengths)))
+    if sort:
+        indices.sort(key=lambda i: lengths[i], reverse=True)
+    batch = []
+    batch_length = 0
+    for index in indices:
+        batch_length = max(batch_length, lengths[index])
+        too_many_tokens = max_batch_tokens is not None and (len(batch) + 1) * batch_length > max_batch_tokens
+        too_big = fits is not None and not fits(len(batch) + 1, batch_length)
+        if len(batch) == batch_size or (batch and (too_many_tokens or too_big)):
+            yield batch
+            batch = []
+            batch_length = lengths[index]
+        batch.append(index)
+    if batch:
         yield batch
 
 
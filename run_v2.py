@@ -1,9 +1,9 @@
-import os
 import fire
 from transformers import AutoModelForCausalLM
 import torch
 
-from quest.infer import infer
+from quest.infer import infer, infer_sweep
+from quest.manifest import is_run_complete
 
 temperatures = [1.4, 1.0, 1.8, 2.2, 0.6]
 top_p = [0.6, 0.7, 0.8, 0.9, 0.95, 0.98]
@@ -64,16 +64,14 @@ def get_output_name(model_slug, temperature, top_p, min_p):
         name.append("top_p_{:02d}".format(int(top_p * 100)))
     if min_p is not None:
         name.append("min_p_{:02d}".format(int(min_p * 100)))
-    return = "_".join(name)
+    return "_".join(name)
 
 
-def run_exp(
-    model_name: str,
+def get_output_path(
     model_slug: str,
     temperature: float,
     top_p: float = None,
-    min_p: float = None,
-    model: AutoModelForCausalLM = None
+    min_p: float = None
 ):
     output_name = get_output_name(
         model_slug=model_slug,
@@ -83,11 +81,27 @@ def run_exp(
     )
     if output_name in BORING_OUTPUTS or output_name in CRAZY_OUTPUTS:
         print(f"skipping {output_name}")
-        return
+        return None
 
     output_path = f"data/outputs/v2/{output_name}.jsonl"
-    if os.path.exists(output_path):
-        print(f"{output_path} exists, skipping!")
+    if is_run_complete(output_path):
+        print(f"{output_path} is complete, skipping!")
+        return None
+    return output_path
+
+
+def run_exp(
+    model_name: str,
+    model_slug: str,
+    temperature: float,
+    top_p: float = None,
+    min_p: float = None,
+    batch_size: int = 3,
+    degeneration: bool = False,
+    model: AutoModelForCausalLM = None
+):
+    output_path = get_output_path(model_slug=model_slug, temperature=temperature, top_p=top_p, min_p=min_p)
+    if output_path is None:
         return
     infer(
         input_path="data/prompts/all_v2.jsonl",
@@ -97,6 +111,8 @@ def run_exp(
         temperature=temperature,
         top_p=top_p,
         min_p=min_p,
+        batch_size=batch_size,
+        degeneration=degeneration,
         model=model
     )
 
@@ -104,6 +120,9 @@ def run_exp(
 def run_all_exps(
     model_name: str = "openchat/openchat-3.5-0106",
     model_slug: str = "openchat",
+    sweep: bool = False,
+    batch_size: int = 3,
+    degeneration: bool = False
 ):
     model = AutoModelForCausalLM.from_pretrained(
         model_name,
@@ -114,12 +133,36 @@ def run_all_exps(
     model.eval()
     model = torch.compile(model)
 
+    exps = []
     for temp in temperatures:
-        run_exp(temperature=temp, model_name=model_name, model_slug=model_slug, model=model)
+        exps.append({"temperature": temp})
         for tp in top_p:
-            run_exp(temperature=temp, top_p=tp, model_name=model_name, model_slug=model_slug, model=model)
+            exps.append({"temperature": temp, "top_p": tp})
         for mp in min_p:
-            run_exp(temperature=temp, min_p=mp, model_name=model_name, model_slug=model_slug, model=model)
+            exps.append({"temperature": temp, "min_p": mp})
+
+    if not sweep:
+        for exp in exps:
+            run_exp(model_name=model_name, model_slug=model_slug, batch_size=batch_size, degeneration=degeneration, model=model, **exp)
+        return
+
+    # All configs in one pass over the prompts, every batch mixes rows of different configs
+    runs = []
+    for exp in exps:
+        output_path = get_output_path(model_slug=model_slug, **exp)
+        if output_path is not None:
+            runs.append({"output_path": output_path, **exp})
+    if not runs:
+        return
+    infer_sweep(
+        input_path="data/prompts/all_v2.jsonl",
+        runs=runs,
+        model_name=model_name,
+        generation_config_path="configs/temp100.json",
+        batch_size=batch_size,
+        degeneration=degeneration,
+        model=model
+    )
 
 
 if __name__ == "__main__":
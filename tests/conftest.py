@@ -0,0 +1,71 @@
+import json
+
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import GenerationConfig, LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+CHARS = "abcdefghijklmnopqrstuvwxyz ABCDEFGHIJKLMNOPQRSTUVWXYZ:.,!?'\n#0123456789"
+
+
+@pytest.fixture(scope="session")
+def model_dir(tmp_path_factory):
+    '''A tiny random Llama with a character level tokenizer, saved like a model from the hub.'''
+    path = tmp_path_factory.mktemp("tiny_llama")
+    vocab = {"<pad>": 0, "<s>": 1, "</s>": 2, "<unk>": 3}
+    for char in CHARS:
+        vocab.setdefault(char, len(vocab))
+    tokenizer_object = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer_object.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tokenizer_object.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer_object,
+        bos_token="<s>",
+        eos_token="</s>",
+        pad_token="<pad>",
+        unk_token="<unk>",
+        padding_side="left"
+    )
+    tokenizer.save_pretrained(path)
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=len(vocab),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=512,
+        pad_token_id=0,
+        bos_token_id=1,
+        eos_token_id=2
+    )
+    LlamaForCausalLM(config).save_pretrained(path)
+    GenerationConfig(pad_token_id=0, bos_token_id=1, eos_token_id=2).save_pretrained(path)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def model(model_dir):
+    return LlamaForCausalLM.from_pretrained(model_dir).eval()
+
+
+@pytest.fixture
+def write_config(tmp_path):
+    def write(name, **params):
+        path = tmp_path / f"{name}.json"
+        path.write_text(json.dumps(params))
+        return str(path)
+    return write
+
+
+@pytest.fixture
+def write_prompts(tmp_path):
+    def write(prompts, name="prompts"):
+        '''Records from prompt strings, or the records themselves.'''
+        records = [prompt if isinstance(prompt, dict) else {"prompt": prompt, "id": i} for i, prompt in enumerate(prompts)]
+        path = tmp_path / f"{name}.jsonl"
+        path.write_text("".join(json.dumps(record) + "\n" for record in records))
+        return str(path)
+    return write
@@ -0,0 +1,59 @@
+import pytest
+import torch
+
+from quest.degeneration import DegenerationDetector, load_degeneration_params
+
+
+def run_detector(detector, token_ids, scores):
+    '''Feeds the tokens one step at a time, `scores` are the final scores of every step.'''
+    for step in range(token_ids.shape[1]):
+        detector.update(token_ids[:, :step + 1], scores[:, step])
+    return detector
+
+
+def peaked_scores(token_ids, vocab_size):
+    scores = torch.full((*token_ids.shape, vocab_size), -10.0)
+    scores.scatter_(-1, token_ids.unsqueeze(-1), 10.0)
+    return scores
+
+
+def test_flags_loops_and_token_soup():
+    generator = torch.Generator().manual_seed(0)
+    vocab_size = 100
+    varied = torch.randperm(vocab_size, generator=generator)[:32]
+    loop = torch.tensor([5, 6, 7, 8] * 8)
+    token_ids = torch.stack((varied, loop, varied))
+    scores = peaked_scores(token_ids, vocab_size)
+    # Flat distribution for the third row
+    scores[2] = 0.0
+    detector = run_detector(DegenerationDetector(window=16, max_entropy=3.0, max_rank=10, max_repetition=0.5, ngram_size=2), token_ids, scores)
+    assert detector.reasons == [None, "repetition", "entropy"]
+    assert detector.stop_steps[0] is None
+    # Nothing is checked before the window is full
+    assert detector.stop_steps[1] == detector.stop_steps[2] == 15
+
+
+def test_rows_can_join_and_leave():
+    vocab_size = 50
+    loop = torch.tensor([[1, 2] * 12])
+    detector = DegenerationDetector(window=8, max_entropy=3.0, max_rank=10, max_repetition=0.5, ngram_size=2)
+    run_detector(detector, loop[:, :6], peaked_scores(loop[:, :6], vocab_size))
+    joined = DegenerationDetector(window=8, max_entropy=3.0, max_rank=10, max_repetition=0.5, ngram_size=2)
+    run_detector(joined, loop[:, :1], peaked_scores(loop[:, :1], vocab_size))
+    detector.append_rows(joined)
+    # Both rows go on with the same loop, the second one is 5 tokens behind and padded on the left
+    for step in range(6, 16):
+        token_ids = torch.cat((loop[:, :step + 1], torch.cat((torch.zeros((1, 5), dtype=torch.long), loop[:, :step - 4]), dim=1)))
+        detector.update(token_ids, peaked_scores(token_ids[:, -1], vocab_size))
+    assert detector.reasons == ["repetition", "repetition"]
+    assert detector.stop_steps == [7, 7]
+    detector.select_rows([1])
+    assert detector.reasons == ["repetition"] and detector.steps == [11]
+
+
+def test_load_params():
+    assert load_degeneration_params(False) is None
+    assert load_degeneration_params(True)["window"] == 64
+    assert load_degeneration_params({"window": 8})["window"] == 8
+    with pytest.raises(ValueError):
+        load_degeneration_params({"windows": 8})
@@ -0,0 +1,61 @@
+import random
+
+import torch
+from transformers import GenerationConfig, GenerationMixin
+from transformers.generation.logits_process import LogitsProcessorList
+
+import quest.infer  # noqa: F401, patches the generation of transformers
+from quest.sampler_hijack import DRYLogitsProcessor, reset_logits_processors
+
+
+def naive_match_lengths(tokens, allowed_length, sequence_breakers):
+    '''Longest repeat of a suffix for every token that follows one of its earlier occurrences, by rescanning the context.'''
+    match_lengths = dict()
+    for end in range(len(tokens) - 1):
+        length = 0
+        while (
+            length <= end
+            and tokens[end - length] == tokens[len(tokens) - 1 - length]
+            and tokens[end - length] not in sequence_breakers
+        ):
+            length += 1
+        token = tokens[end + 1]
+        if length >= allowed_length and token not in sequence_breakers:
+            match_lengths[token] = max(match_lengths.get(token, 0), length)
+    return match_lengths
+
+
+def test_incremental_penalties_match_rescan():
+    rng = random.Random(0)
+    vocab_size, sequence_breakers = 6, {5}
+    processor = DRYLogitsProcessor(multiplier=0.8, base=1.75, allowed_length=2, sequence_breakers=sequence_breakers)
+    rows = [[rng.randrange(vocab_size) for _ in range(8)] for _ in range(3)]
+    for step in range(40):
+        input_ids = torch.tensor(rows)
+        penalties = processor(input_ids, torch.zeros((len(rows), vocab_size)))
+        for row, tokens in enumerate(rows):
+            expected = torch.zeros(vocab_size)
+            for token, length in naive_match_lengths(tokens, 2, sequence_breakers).items():
+                expected[token] = -processor.penalty(length)
+            assert torch.allclose(penalties[row], expected), f"step {step}, row {row}"
+        for tokens in rows:
+            # Mostly repeats, so the matches get long
+            tokens.append(tokens[-4] if rng.random() < 0.7 else rng.randrange(vocab_size))
+
+
+def test_applies_to_greedy_decoding():
+    generation_config = GenerationConfig(do_sample=False, dry_multiplier=0.8)
+    input_ids = torch.tensor([[1, 2, 3, 1, 2]])
+    processors = GenerationMixin()._get_logits_processor(
+        generation_config=generation_config,
+        input_ids_seq_length=input_ids.shape[1],
+        encoder_input_ids=input_ids,
+        prefix_allowed_tokens_fn=None,
+        logits_processor=LogitsProcessorList()
+    )
+    reset_logits_processors(processors)
+    scores = processors(input_ids, torch.zeros((1, 8)))
+    # 3 continues the repeat of [1, 2]
+    assert scores[0, 3] < 0
+    assert scores[0].argmax() != 3
+    assert (scores[0, [0, 1, 2, 4, 5, 6, 7]] == 0).all()
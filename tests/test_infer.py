@@ -0,0 +1,215 @@
+import json
+
+import pytest
+import torch
+
+import quest.infer
+import quest.output_writer
+from quest.infer import infer, infer_sweep
+from quest.manifest import RunManifest
+from quest.meta_shard import MetaShardReader
+
+# Different lengths, so static batches are padded
+PROMPTS = [
+    "the cat sat on the mat",
+    "hi",
+    "a b a b a b a b",
+    "Once upon a time there was a tiny model that repeated itself",
+    "ab",
+    "what: is this?",
+]
+
+CONFIGS = {
+    "mirostat_repetition": dict(do_sample=True, repetition_penalty=1.3, mirostat_mode=2, mirostat_tau=5.0, mirostat_eta=0.1, top_k=None, top_p=None),
+    "tfs_presence": dict(do_sample=True, temperature=1.5, tfs=0.95, presence_penalty=0.5, frequency_penalty=0.2, top_k=None, top_p=None),
+    "greedy_repetition_dry": dict(do_sample=False, repetition_penalty=1.5, dry_multiplier=0.8),
+}
+
+
+def read_records(path):
+    with open(path, encoding="utf-8") as r:
+        return [json.loads(line) for line in r]
+
+
+def read_outputs(path):
+    return [record["output"] for record in read_records(path)]
+
+
+def read_metas(output_path):
+    return [{name: value.clone() for name, value in meta.items()} for meta in MetaShardReader(output_path[:-len(".jsonl")])]
+
+
+def run(tmp_path, name, prompts_path, model_dir, model, config_path, **kwargs):
+    output_path = str(tmp_path / f"{name}.jsonl")
+    infer(prompts_path, output_path, model_dir, config_path, model=model, echo=False, prompt_cache_dir=str(tmp_path / "tokenized"), **kwargs)
+    return read_outputs(output_path)
+
+
+@pytest.mark.parametrize("config_name", list(CONFIGS))
+def test_outputs_do_not_depend_on_batching(tmp_path, model_dir, model, write_config, write_prompts, config_name):
+    config_path = write_config(config_name, max_new_tokens=24, **CONFIGS[config_name])
+    prompts_path = write_prompts(PROMPTS)
+    alone = run(tmp_path, "alone", prompts_path, model_dir, model, config_path, batch_size=1)
+    padded = run(tmp_path, "padded", prompts_path, model_dir, model, config_path, batch_size=len(PROMPTS), length_bucketing=False)
+    continuous = run(tmp_path, "continuous", prompts_path, model_dir, model, config_path, batch_size=2, continuous_batching=True)
+    assert padded == alone
+    assert continuous == alone
+
+
+def test_out_of_memory_halves_generate_the_whole_batch(tmp_path, model_dir, model, write_config, write_prompts, monkeypatch):
+    config_path = write_config("config", max_new_tokens=24, **CONFIGS["mirostat_repetition"])
+    prompts_path = write_prompts(PROMPTS)
+    whole = run(tmp_path, "whole", prompts_path, model_dir, model, config_path, batch_size=len(PROMPTS))
+
+    generate = quest.infer.generate
+    batch_sizes = []
+
+    def generate_with_small_memory(**kwargs):
+        batch_sizes.append(len(kwargs["prompt_ids"]))
+        if len(kwargs["prompt_ids"]) > 2:
+            raise torch.cuda.OutOfMemoryError("CUDA out of memory")
+        return generate(**kwargs)
+
+    monkeypatch.setattr(quest.infer, "generate", generate_with_small_memory)
+    halves = run(tmp_path, "halves", prompts_path, model_dir, model, config_path, batch_size=len(PROMPTS))
+    assert batch_sizes == [6, 3, 2, 1, 3, 2, 1]
+    assert halves == whole
+
+
+def test_sweep_matches_separate_runs(tmp_path, model_dir, model, write_config, write_prompts):
+    config_path = write_config("config", max_new_tokens=24, **CONFIGS["mirostat_repetition"])
+    prompts_path = write_prompts(PROMPTS)
+    temperatures = [0.7, 1.0, 1.6]
+    runs = [dict(output_path=str(tmp_path / f"sweep_{i}.jsonl"), temperature=t) for i, t in enumerate(temperatures)]
+    infer_sweep(prompts_path, runs, model_dir, config_path, model=model, batch_size=4, prompt_cache_dir=str(tmp_path / "tokenized"))
+    for i, temperature in enumerate(temperatures):
+        separate = run(tmp_path, f"separate_{i}", prompts_path, model_dir, model, config_path, temperature=temperature)
+        assert read_outputs(runs[i]["output_path"]) == separate
+
+
+@pytest.mark.parametrize("options", [dict(batch_size=2), dict(batch_size=3, continuous_batching=True)])
+def test_resume_after_crash_matches_uninterrupted_run(tmp_path, model_dir, model, write_config, write_prompts, monkeypatch, options):
+    config_path = write_config("config", max_new_tokens=16, **CONFIGS["tfs_presence"])
+    prompts_path = write_prompts(PROMPTS)
+    run(tmp_path, "whole", prompts_path, model_dir, model, config_path, **options)
+
+    output_path = str(tmp_path / "resumed.jsonl")
+    write = quest.output_writer.OutputWriter.write
+    num_writes = [0]
+
+    def crashing_write(self, indices, metas):
+        num_writes[0] += 1
+        if num_writes[0] == 3:
+            raise RuntimeError("Simulated crash")
+        return write(self, indices, metas)
+
+    monkeypatch.setattr(quest.output_writer.OutputWriter, "write", crashing_write)
+    with pytest.raises(RuntimeError):
+        run(tmp_path, "resumed", prompts_path, model_dir, model, config_path, **options)
+    monkeypatch.undo()
+    manifest = RunManifest(output_path[:-len(".jsonl")])
+    done = manifest.read_order()
+    assert 0 < len(done) < len(PROMPTS) and not manifest.is_complete
+    # A torn line after the last commit
+    with open(output_path, "a", encoding="utf-8") as w:
+        w.write('{"prompt": "tor')
+
+    submitted = []
+    submit = quest.output_writer.OutputWriter.submit
+
+    def recording_submit(self, indices, metas):
+        submitted.extend(indices)
+        return submit(self, indices, metas)
+
+    monkeypatch.setattr(quest.output_writer.OutputWriter, "submit", recording_submit)
+    run(tmp_path, "resumed", prompts_path, model_dir, model, config_path, **options)
+    assert sorted(submitted + done) == list(range(len(PROMPTS)))
+    assert RunManifest(output_path[:-len(".jsonl")]).is_complete
+    assert read_records(output_path) == read_records(str(tmp_path / "whole.jsonl"))
+    # Batches after the resume have other rows, so the captured floats may differ in the last bits
+    for meta, whole_meta in zip(read_metas(output_path), read_metas(str(tmp_path / "whole.jsonl")), strict=True):
+        torch.testing.assert_close(meta, whole_meta, rtol=1e-3, atol=1e-5)
+
+
+def test_interrupted_finalize_is_replayed(tmp_path, model_dir, model, write_config, write_prompts, monkeypatch):
+    config_path = write_config("config", max_new_tokens=16, **CONFIGS["tfs_presence"])
+    prompts_path = write_prompts(PROMPTS)
+    whole = run(tmp_path, "whole", prompts_path, model_dir, model, config_path, batch_size=2)
+
+    def crashing_finish(self, output_size):
+        raise RuntimeError("Simulated crash")
+
+    monkeypatch.setattr(RunManifest, "finish", crashing_finish)
+    with pytest.raises(RuntimeError):
+        run(tmp_path, "finalized", prompts_path, model_dir, model, config_path, batch_size=2)
+    monkeypatch.undo()
+    manifest = RunManifest(str(tmp_path / "finalized"))
+    assert manifest.is_finalizing and not manifest.is_complete
+
+    assert run(tmp_path, "finalized", prompts_path, model_dir, model, config_path, batch_size=2) == whole
+    assert RunManifest(str(tmp_path / "finalized")).is_complete
+    assert len(read_metas(str(tmp_path / "finalized.jsonl"))) == len(PROMPTS)
+
+
+def test_samples_do_not_depend_on_shared_prefill(tmp_path, model_dir, model, write_config, write_prompts):
+    config_path = write_config("config", max_new_tokens=16, **CONFIGS["mirostat_repetition"])
+    prompts_path = write_prompts(PROMPTS[:3])
+    alone = run(tmp_path, "alone", prompts_path, model_dir, model, config_path, batch_size=1, num_samples=3)
+    shared = run(tmp_path, "shared", prompts_path, model_dir, model, config_path, batch_size=9, num_samples=3)
+    continuous = run(tmp_path, "continuous", prompts_path, model_dir, model, config_path, batch_size=4, continuous_batching=True, num_samples=3)
+    assert shared == alone
+    assert continuous == alone
+    records = read_records(str(tmp_path / "shared.jsonl"))
+    assert [(r["id"], r["sample_iteration"]) for r in records] == [(i, j) for i in range(3) for j in range(3)]
+    # Every sample has its own seed
+    assert len(set(alone[:3])) > 1
+
+
+@pytest.mark.parametrize("options", [dict(batch_size=3), dict(batch_size=3, continuous_batching=True)])
+def test_stop_strings_cut_outputs_of_their_source(tmp_path, model_dir, model, write_config, write_prompts, options):
+    config_path = write_config("config", max_new_tokens=32, **CONFIGS["tfs_presence"])
+    prompts_path = write_prompts([{"prompt": prompt, "source": ["chat", "story"][i % 2]} for i, prompt in enumerate(PROMPTS)])
+    full = run(tmp_path, "full", prompts_path, model_dir, model, config_path, **options)
+    # Stop at the first space of every chat output that has one
+    stop_strings = {"chat": [" "]}
+    stopped = run(tmp_path, "stopped", prompts_path, model_dir, model, config_path, stop_strings=stop_strings, **options)
+    num_stopped = 0
+    for i, (full_output, output) in enumerate(zip(full, stopped)):
+        if i % 2 == 0 and " " in full_output:
+            num_stopped += 1
+            assert output == full_output[:full_output.index(" ") + 1]
+        else:
+            assert output == full_output
+    assert num_stopped > 0
+    reasons = [r.get("stop_reason") for r in read_records(str(tmp_path / "stopped.jsonl"))]
+    assert reasons.count("stop_string") == num_stopped
+
+
+def test_degeneration_detector_only_cuts_outputs(tmp_path, model_dir, model, write_config, write_prompts):
+    config_path = write_config("config", max_new_tokens=48, do_sample=True, temperature=2.5, top_k=None, top_p=None)
+    prompts_path = write_prompts(PROMPTS)
+    full = run(tmp_path, "full", prompts_path, model_dir, model, config_path, batch_size=3)
+    degeneration = dict(window=8, max_entropy=3.0, ngram_size=2)
+    cut = run(tmp_path, "cut", prompts_path, model_dir, model, config_path, batch_size=3, degeneration=degeneration)
+    continuous = run(tmp_path, "continuous", prompts_path, model_dir, model, config_path, batch_size=3, continuous_batching=True, degeneration=degeneration)
+    assert continuous == cut
+    records = read_records(str(tmp_path / "cut.jsonl"))
+    assert any(r["stop_reason"] in ("entropy", "rank", "repetition") for r in records)
+    for full_output, record in zip(full, records):
+        assert full_output.startswith(record["output"].rstrip())
+        if record["stop_reason"] in ("entropy", "rank", "repetition"):
+            assert len(record["output"]) < len(full_output)
+
+
+def test_meta_of_greedy_run(tmp_path, model_dir, model, write_config, write_prompts):
+    config_path = write_config("config", max_new_tokens=16, **CONFIGS["greedy_repetition_dry"])
+    prompts_path = write_prompts(PROMPTS)
+    output_path = str(tmp_path / "greedy.jsonl")
+    outputs = run(tmp_path, "greedy", prompts_path, model_dir, model, config_path, batch_size=4)
+    tokenizer = quest.infer.AutoTokenizer.from_pretrained(model_dir)
+    for output, meta in zip(outputs, read_metas(output_path), strict=True):
+        assert tokenizer.decode(meta["output_ids"], skip_special_tokens=True) == output
+        assert meta["logits_values"].shape == meta["scores_values"].shape == (len(meta["output_ids"]), 30)
+        # Greedy search picks the top token of the final scores, the captures are sorted
+        assert torch.equal(meta["scores_indices"][:, 0].long(), meta["output_ids"].long())
+        assert (meta["logits_values"][:, :-1] >= meta["logits_values"][:, 1:]).all()
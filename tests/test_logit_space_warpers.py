@@ -0,0 +1,60 @@
+import pytest
+import torch
+from transformers.generation.logits_process import EpsilonLogitsWarper, EtaLogitsWarper
+
+from quest.sampler_hijack import (
+    EpsilonLogitSpaceWarper,
+    EtaLogitSpaceWarper,
+    MinPLogitSpaceWarper,
+    MinPLogitsWarper,
+    TopALogitSpaceWarper,
+    TopALogitsWarper
+)
+
+WARPER_PAIRS = [
+    (MinPLogitsWarper, MinPLogitSpaceWarper, "min_p", [0.02, 0.1, 0.5]),
+    (TopALogitsWarper, TopALogitSpaceWarper, "top_a", [0.05, 0.2, 1.0]),
+    (EpsilonLogitsWarper, EpsilonLogitSpaceWarper, "epsilon", [3e-4, 1e-3, 0.05]),
+    (EtaLogitsWarper, EtaLogitSpaceWarper, "epsilon", [3e-4, 1e-3, 0.05]),
+]
+
+
+def random_scores(seed, tied):
+    generator = torch.Generator().manual_seed(seed)
+    scores = torch.randn((4, 32000), generator=generator) * 4
+    scores[0, :100] = -float("inf")
+    if tied:
+        # Logits of real models are bf16 values, many of them are equal
+        scores = scores.to(torch.bfloat16).float()
+        scores[1, :50] = scores[1].max()
+        scores[2, :1000] = scores[2, 1000:].min()
+        scores[3] = scores[3].round()
+    return scores
+
+
+def kept_mask(warper, scores):
+    return warper(None, scores.clone()) != -float("inf")
+
+
+@pytest.mark.parametrize("tied", [False, True])
+@pytest.mark.parametrize("min_tokens_to_keep", [1, 3, 100])
+@pytest.mark.parametrize("probability_class,logit_class,name,values", WARPER_PAIRS)
+def test_same_mask_as_probability_space(probability_class, logit_class, name, values, min_tokens_to_keep, tied):
+    for seed in range(5):
+        scores = random_scores(seed, tied)
+        for value in values:
+            params = {name: value, "min_tokens_to_keep": min_tokens_to_keep}
+            expected = kept_mask(probability_class(**params), scores)
+            actual = kept_mask(logit_class(**params), scores)
+            assert torch.equal(actual, expected), f"{logit_class.__name__} {name}={value} keeps {actual.sum(-1).tolist()}, expected {expected.sum(-1).tolist()}"
+
+
+@pytest.mark.parametrize("probability_class,logit_class,name,values", WARPER_PAIRS)
+def test_keeps_min_tokens_of_flat_distribution(probability_class, logit_class, name, values):
+    scores = torch.zeros((2, 1000))
+    scores[1, :10] = 5.0
+    params = {name: values[-1], "min_tokens_to_keep": 20}
+    expected = kept_mask(probability_class(**params), scores)
+    actual = kept_mask(logit_class(**params), scores)
+    assert torch.equal(actual, expected)
+    assert (actual.sum(-1) >= 20).all()
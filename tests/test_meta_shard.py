@@ -0,0 +1,52 @@
+import numpy as np
+import torch
+
+from quest.meta_shard import MetaShardReader, MetaShardWriter
+
+
+def random_meta(generator, num_tokens, k=4):
+    return {
+        "logits_values": torch.randn((num_tokens, k), generator=generator, dtype=torch.float32).to(torch.bfloat16),
+        "logits_indices": torch.randint(0, 1000, (num_tokens, k), generator=generator),
+        "scores_values": torch.randn((num_tokens, k), generator=generator),
+        "scores_indices": torch.randint(0, 1000, (num_tokens, k), generator=generator),
+        "output_ids": torch.randint(0, 1000, (num_tokens,), generator=generator),
+    }
+
+
+def assert_same_meta(actual, expected):
+    assert actual.keys() == expected.keys()
+    for name in expected:
+        # Values are stored as float16
+        expected_value = expected[name].float().half() if expected[name].is_floating_point() else expected[name]
+        assert torch.equal(actual[name].to(expected_value.dtype), expected_value), name
+
+
+def test_round_trip(tmp_path):
+    generator = torch.Generator().manual_seed(0)
+    metas = [random_meta(generator, num_tokens) for num_tokens in (5, 1, 0, 12)]
+    with MetaShardWriter(tmp_path / "shard", k=4) as writer:
+        for meta in metas:
+            writer.write(meta)
+    reader = MetaShardReader(tmp_path / "shard")
+    assert len(reader) == 4 and reader.k == 4 and reader.num_tokens == 18
+    for actual, expected in zip(reader, metas, strict=True):
+        assert_same_meta(actual, expected)
+    assert torch.equal(reader.get(3, 2, 5)["output_ids"], metas[3]["output_ids"][2:5].int())
+    assert torch.equal(reader.column("output_ids"), torch.cat([meta["output_ids"] for meta in metas]).int())
+    assert torch.equal(reader[-1]["logits_indices"], metas[-1]["logits_indices"].int())
+
+
+def test_resume_drops_samples_after_the_kept_ones(tmp_path):
+    generator = torch.Generator().manual_seed(0)
+    metas = [random_meta(generator, num_tokens) for num_tokens in (3, 4, 5, 6)]
+    with MetaShardWriter(tmp_path / "shard", k=4) as writer:
+        for meta in metas[:3]:
+            writer.write(meta)
+    with MetaShardWriter(tmp_path / "shard", k=4, num_samples=2) as writer:
+        writer.write(metas[3])
+    reader = MetaShardReader(tmp_path / "shard")
+    assert len(reader) == 3 and reader.num_tokens == 13
+    for actual, expected in zip(reader, [metas[0], metas[1], metas[3]], strict=True):
+        assert_same_meta(actual, expected)
+    assert np.fromfile(tmp_path / "shard" / "output_ids.bin", dtype=np.int32).shape == (13,)
@@ -0,0 +1,43 @@
+import torch
+
+from quest.prefix_cache import PrefixKVCache
+
+
+def fake_past_key_values(token_ids):
+    # One layer of keys and values, [batch, heads, tokens, head_dim]
+    tensor = torch.tensor(token_ids, dtype=torch.float32).view(1, 1, -1, 1)
+    return ((tensor, tensor.clone()),)
+
+
+def entry_bytes(length):
+    return 2 * length * 4
+
+
+def test_reuses_longest_shared_prefix():
+    cache = PrefixKVCache(max_bytes=10 ** 6, block_size=4)
+    cache.add(list(range(12)), fake_past_key_values(list(range(12))))
+    length, past_key_values = cache.lookup(list(range(10)) + [99, 98])
+    assert length == 10
+    assert past_key_values[0][0].flatten().tolist() == list(range(10))
+    # The last token is always left to compute
+    assert cache.lookup(list(range(12)))[0] == 11
+    assert cache.lookup([99] + list(range(11))) == (0, None)
+
+
+def test_evicting_a_prompt_keeps_other_prompts_with_the_same_prefix():
+    first = list(range(8)) + [50, 51, 52, 53]
+    second = list(range(8)) + [60, 61, 62, 63]
+    third = [70] * 12
+    cache = PrefixKVCache(max_bytes=entry_bytes(24), block_size=4)
+    cache.add(first, fake_past_key_values(first))
+    cache.add(second, fake_past_key_values(second))
+    # The first prompt becomes the most recently used one, the second is evicted by the third
+    assert cache.lookup(first + [0])[0] == 12
+    cache.add(third, fake_past_key_values(third))
+    assert list(cache.entries) == [tuple(first), tuple(third)]
+
+    length, past_key_values = cache.lookup(list(range(8)) + [80, 81, 82, 83])
+    assert length == 8
+    assert past_key_values[0][0].flatten().tolist() == list(range(8))
+    assert cache.lookup(first + [0])[0] == 12
+    assert set(key for keys in cache.block_index.values() for key in keys) == {tuple(first), tuple(third)}
@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from quest.sampler_hijack import RepetitionPenaltyLogitsProcessorWithRange
+
+
+def window_counts(tokens, _range, vocab_size):
+    window = tokens[-_range:] if _range > 0 else tokens
+    return torch.bincount(torch.tensor(window, dtype=torch.long), minlength=vocab_size)
+
+
+@pytest.mark.parametrize("_range", [0, 1, 5, 64])
+def test_incremental_counts_match_recount(_range):
+    generator = torch.Generator().manual_seed(0)
+    vocab_size = 12
+    processor = RepetitionPenaltyLogitsProcessorWithRange(1.3, 0.5, 0.2, _range)
+    input_ids = torch.randint(0, vocab_size, (3, 10), generator=generator)
+    for step in range(30):
+        scores = torch.randn((3, vocab_size), generator=generator)
+        processor(input_ids, scores.clone())
+        for row in range(3):
+            assert torch.equal(processor.counts[row].long(), window_counts(input_ids[row].tolist(), _range, vocab_size)), f"step {step}"
+        input_ids = torch.cat((input_ids, torch.randint(0, vocab_size, (3, 1), generator=generator)), dim=1)
+
+
+@pytest.mark.parametrize("_range", [0, 4, 64])
+def test_left_padding_is_not_counted(_range):
+    generator = torch.Generator().manual_seed(0)
+    vocab_size, pad_token_id = 12, 0
+    prompts = [[5, 6, 7, 5, 6, 8, 9], [3, 4], [7, 7, 1, 2, 3]]
+    padded = RepetitionPenaltyLogitsProcessorWithRange(1.3, 0.5, 0.2, _range)
+    padded.prompt_lengths = torch.tensor([len(prompt) for prompt in prompts])
+    alone = [RepetitionPenaltyLogitsProcessorWithRange(1.3, 0.5, 0.2, _range) for _ in prompts]
+    max_length = max(len(prompt) for prompt in prompts)
+    input_ids = torch.tensor([[pad_token_id] * (max_length - len(prompt)) + prompt for prompt in prompts])
+    for step in range(12):
+        scores = torch.randn((len(prompts), vocab_size), generator=generator)
+        padded_scores = padded(input_ids, scores.clone())
+        for row, processor in enumerate(alone):
+            row_ids = input_ids[row:row + 1, max_length - len(prompts[row]):]
+            assert torch.equal(padded_scores[row:row + 1], processor(row_ids, scores[row:row + 1].clone())), f"step {step}, row {row}"
+        input_ids = torch.cat((input_ids, torch.randint(1, vocab_size, (len(prompts), 1), generator=generator)), dim=1)
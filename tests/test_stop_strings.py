@@ -0,0 +1,27 @@
+from transformers import AutoTokenizer
+
+from quest.stop_strings import StopStringMatcher, get_token_strings
+
+
+def matches(tokenizer, stop_strings, text_or_ids):
+    token_ids = text_or_ids if isinstance(text_or_ids, list) else tokenizer.encode(text_or_ids, add_special_tokens=False)
+    matcher = StopStringMatcher(stop_strings, get_token_strings(tokenizer))
+    steps = [step for step, token_id in enumerate(token_ids) if matcher.update(token_id)]
+    return steps[0] if steps else None
+
+
+def test_matches_across_tokens(model_dir):
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    assert matches(tokenizer, ["\nUser:"], "Sure.\nUser: hi") == 10
+    assert matches(tokenizer, ["\nUser:"], "Sure. User: hi") is None
+    assert matches(tokenizer, ["x", "ure"], "Sure") == 3
+
+
+def test_special_tokens_add_no_text(model_dir):
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    a, b = tokenizer.convert_tokens_to_ids(["a", "b"])
+    # The decoded output skips special tokens, so their text never matches and never splits a match
+    assert matches(tokenizer, ["unk"], [a, tokenizer.unk_token_id, b]) is None
+    assert matches(tokenizer, ["</s>", "s>"], [a, tokenizer.eos_token_id]) is None
+    assert matches(tokenizer, ["ab"], [a, tokenizer.unk_token_id, tokenizer.pad_token_id, b]) == 3
+    assert tokenizer.decode([a, tokenizer.unk_token_id, b], skip_special_tokens=True) == "ab"
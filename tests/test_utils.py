@@ -0,0 +1,62 @@
+import random
+
+from quest.utils import expand_samples, gen_length_batches, record_seeds
+
+
+def test_length_batches_cover_every_index_once():
+    rng = random.Random(0)
+    lengths = [rng.randrange(1, 100) for _ in range(50)]
+    batches = list(gen_length_batches(lengths, batch_size=8))
+    assert sorted(i for batch in batches for i in batch) == list(range(50))
+    assert all(len(batch) <= 8 for batch in batches)
+    # Longest first and grouped, so batches don't overlap in length
+    flat_lengths = [lengths[i] for batch in batches for i in batch]
+    assert flat_lengths == sorted(lengths, reverse=True)
+
+
+def test_length_batches_keep_order_without_sorting():
+    batches = list(gen_length_batches([3, 9, 1, 5, 7], batch_size=2, sort=False))
+    assert batches == [[0, 1], [2, 3], [4]]
+
+
+def test_length_batches_respect_token_budget():
+    lengths = [10, 40, 20, 30, 5]
+    batches = list(gen_length_batches(lengths, batch_size=10, max_batch_tokens=60))
+    assert batches == [[1], [3, 2], [0, 4]]
+    assert all(len(batch) * max(lengths[i] for i in batch) <= 60 for batch in batches)
+
+
+def test_length_batches_ask_fits_for_every_batch():
+    calls = []
+
+    def fits(num_sequences, max_length):
+        calls.append((num_sequences, max_length))
+        return num_sequences * max_length <= 50
+
+    batches = list(gen_length_batches([10, 20, 30, 10], batch_size=4, fits=fits))
+    assert batches == [[2], [1, 0], [3]]
+    assert calls[0] == (1, 30)
+
+
+def test_record_seeds_depend_on_records_only():
+    records = [{"prompt": "a"}, {"prompt": "b"}, {"prompt": "a"}]
+    seeds = record_seeds(records, 42)
+    assert record_seeds([records[1], records[0]], 42) == [seeds[1], seeds[0]]
+    assert record_seeds([records[1]], 42) == [seeds[1]]
+    # Repeated records get their own seeds
+    assert len(set(seeds)) == 3
+    assert record_seeds(records, 43) != seeds
+
+
+def test_expand_samples():
+    records = [{"prompt": "a"}, {"prompt": "b"}]
+    assert expand_samples(records, 1) == (records, [0, 1])
+    samples, source_indices = expand_samples(records, 2)
+    assert samples == [
+        {"prompt": "a", "sample_iteration": 0},
+        {"prompt": "a", "sample_iteration": 1},
+        {"prompt": "b", "sample_iteration": 0},
+        {"prompt": "b", "sample_iteration": 1},
+    ]
+    assert source_indices == [0, 0, 1, 1]
+    assert len(set(record_seeds(samples, 42))) == 4